@@ -0,0 +1,361 @@
+"""A local stand-in for the Azure OpenAI Assistants and Files endpoints.
+
+Serves the calls the backend makes, keeps everything in memory and plays
+runs out on a timer, so main.app can be load tested without a deployment.
+It also serves the files behind fileURLs (/data/<name>) and accepts the
+Logic Apps emails (/email). Run it from src/backend:
+
+    python benchmarks/fake_openai.py --port 9999 --run-seconds 1 --tool-rate 0.3
+
+The scenario can be changed while it runs with POST /_scenario and the
+request counts are returned by GET /_stats. Prompts containing [tools] or
+[image] always call the tools or return an image.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, File, Form, Request, UploadFile
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+
+# A 1x1 transparent PNG
+PNG = bytes.fromhex("89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+                    "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082")
+
+# The arguments of the calls made to each tool of the registry in tools.py
+TOOL_ARGUMENTS = {
+    "get_stock_price": [{"symbol": "MSFT"}, {"symbol": "AAPL"}],
+    "get_country_data": [{"country": "France"}],
+    "send_email": [{"to": "someone@example.com", "content": "Benchmark"}],
+}
+
+
+class Scenario(BaseModel):
+    # How long a run stays in progress before it needs attention (seconds)
+    run_seconds: float = 1.0
+    run_jitter: float = 0.2
+    # Share of the runs that call tools once, and of the answers with an image
+    tool_rate: float = 0.0
+    image_rate: float = 0.0
+    tools: list[str] = ["get_stock_price", "send_email"]
+    # Share of the API calls answered with a 429 and the Retry-After they get (ms)
+    throttle_rate: float = 0.0
+    throttle_ms: int = 200
+    # Added to every API call to stand in for the network (seconds)
+    latency: float = 0.0
+
+
+class Store:
+    def __init__(self, scenario: Scenario, seed: int | None):
+        self.scenario = scenario
+        self.random = random.Random(seed)
+        self.assistants: dict[str, dict] = {}
+        self.threads: dict[str, dict] = {}
+        self.messages: dict[str, list[dict]] = {}
+        self.runs: dict[str, dict] = {}
+        self.files: dict[str, dict] = {}
+        self.emails = 0
+        self.counts: dict[str, int] = {}
+
+    def count(self, key: str):
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+
+def new_id(prefix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def not_found(kind: str, id: str) -> JSONResponse:
+    return JSONResponse({"error": {"code": "not_found", "message": f"No {kind} found with id '{id}'."}}, 404)
+
+
+def public(item: dict) -> dict:
+    # Keys starting with _ are the fake's own state
+    return {key: value for (key, value) in item.items() if not key.startswith("_")}
+
+
+def page(items: list[dict], order: str, after: str | None, limit: int) -> dict:
+    if order == "desc":
+        items = list(reversed(items))
+    if after is not None:
+        ids = [item["id"] for item in items]
+        if after in ids:
+            items = items[ids.index(after) + 1:]
+    data = [public(item) for item in items[:limit]]
+    return {"object": "list", "data": data,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None,
+            "has_more": len(items) > limit}
+
+
+def create_app(scenario: Scenario, seed: int | None = None) -> FastAPI:
+    app = FastAPI()
+    store = Store(scenario, seed)
+
+    @app.middleware("http")
+    async def simulate(request: Request, call_next):
+        # Count the operations with their ids left out
+        segments = [("{id}" if "_" in segment else segment)
+                    for segment in request.url.path.split("/")]
+        store.count(f"{request.method} {'/'.join(segments)}")
+        if request.url.path.startswith("/openai/"):
+            if store.scenario.latency > 0:
+                await asyncio.sleep(store.scenario.latency)
+            if store.random.random() < store.scenario.throttle_rate:
+                store.count("throttled")
+                return JSONResponse({"error": {"code": "429", "message": "Rate limit is exceeded."}}, 429,
+                                    headers={"retry-after-ms": str(store.scenario.throttle_ms)})
+        return await call_next(request)
+
+    def add_message(thread_id: str, role: str, text: str, image_id: str | None = None,
+                    assistant_id: str | None = None, run_id: str | None = None) -> dict:
+        content = [{"type": "text", "text": {"value": text, "annotations": []}}]
+        if image_id is not None:
+            content.append({"type": "image_file", "image_file": {"file_id": image_id}})
+        message = {"id": new_id("msg"), "object": "thread.message", "created_at": int(time.time()),
+                   "thread_id": thread_id, "role": role, "content": content, "file_ids": [],
+                   "assistant_id": assistant_id, "run_id": run_id, "metadata": {}}
+        store.messages[thread_id].append(message)
+        return message
+
+    def add_step(run: dict, type: str, status: str, details: dict) -> dict:
+        step = {"id": new_id("step"), "object": "thread.run.step", "created_at": int(time.time()),
+                "run_id": run["id"], "assistant_id": run["assistant_id"], "thread_id": run["thread_id"],
+                "type": type, "status": status, "step_details": {"type": type, **details}}
+        run["_steps"].append(step)
+        return step
+
+    def schedule(run: dict):
+        jitter = store.scenario.run_seconds * store.scenario.run_jitter
+        run["_due"] = time.time() + max(0.0, store.random.uniform(
+            store.scenario.run_seconds - jitter, store.scenario.run_seconds + jitter))
+
+    def advance(run: dict):
+        """Move the run along once its time is up."""
+        if run["status"] not in ("queued", "in_progress"):
+            return
+        if time.time() < run["_due"]:
+            run["status"] = "in_progress"
+            return
+        if run["_tools"]:
+            calls = [{"id": new_id("call"), "type": "function",
+                      "function": {"name": name, "arguments": json.dumps(arguments)}}
+                     for name in run["_tools"] for arguments in TOOL_ARGUMENTS.get(name, [{}])]
+            run["_tools"] = []
+            run["status"] = "requires_action"
+            run["required_action"] = {"type": "submit_tool_outputs",
+                                      "submit_tool_outputs": {"tool_calls": calls}}
+            add_step(run, "tool_calls", "in_progress", {"tool_calls": calls})
+            return
+        image_id = None
+        if run["_image"]:
+            image_id = new_id("file")
+            store.files[image_id] = {"id": image_id, "object": "file", "bytes": len(PNG),
+                                     "created_at": int(time.time()), "filename": "chart.png",
+                                     "purpose": "assistants_output", "status": "processed", "_data": PNG}
+        message = add_message(run["thread_id"], "assistant", f"Answer to: {run['_prompt']}",
+                              image_id, run["assistant_id"], run["id"])
+        add_step(run, "message_creation", "completed",
+                 {"message_creation": {"message_id": message["id"]}})
+        run["status"] = "completed"
+        run["completed_at"] = int(time.time())
+
+    # Assistants
+    @app.post("/openai/assistants")
+    async def create_assistant(request: Request):
+        body = await request.json()
+        assistant = {"id": new_id("asst"), "object": "assistant", "created_at": int(time.time()),
+                     "name": None, "description": None, "instructions": None, "tools": [],
+                     "file_ids": [], "metadata": {}, **body}
+        store.assistants[assistant["id"]] = assistant
+        return assistant
+
+    @app.get("/openai/assistants/{assistant_id}")
+    async def get_assistant(assistant_id: str):
+        if assistant_id not in store.assistants:
+            return not_found("assistant", assistant_id)
+        return store.assistants[assistant_id]
+
+    @app.delete("/openai/assistants/{assistant_id}")
+    async def delete_assistant(assistant_id: str):
+        store.assistants.pop(assistant_id, None)
+        return {"id": assistant_id, "object": "assistant.deleted", "deleted": True}
+
+    # Threads and messages
+    @app.post("/openai/threads")
+    async def create_thread():
+        thread = {"id": new_id("thread"), "object": "thread",
+                  "created_at": int(time.time()), "metadata": {}}
+        store.threads[thread["id"]] = thread
+        store.messages[thread["id"]] = []
+        return thread
+
+    @app.get("/openai/threads/{thread_id}")
+    async def get_thread(thread_id: str):
+        if thread_id not in store.threads:
+            return not_found("thread", thread_id)
+        return store.threads[thread_id]
+
+    @app.delete("/openai/threads/{thread_id}")
+    async def delete_thread(thread_id: str):
+        store.threads.pop(thread_id, None)
+        store.messages.pop(thread_id, None)
+        return {"id": thread_id, "object": "thread.deleted", "deleted": True}
+
+    @app.post("/openai/threads/{thread_id}/messages")
+    async def create_message(thread_id: str, request: Request):
+        if thread_id not in store.threads:
+            return not_found("thread", thread_id)
+        body = await request.json()
+        return add_message(thread_id, body["role"], body["content"])
+
+    @app.get("/openai/threads/{thread_id}/messages")
+    async def list_messages(thread_id: str, order: str = "desc", after: str | None = None, limit: int = 20):
+        if thread_id not in store.threads:
+            return not_found("thread", thread_id)
+        return page(store.messages[thread_id], order, after, limit)
+
+    @app.get("/openai/threads/{thread_id}/messages/{message_id}")
+    async def get_message(thread_id: str, message_id: str):
+        for message in store.messages.get(thread_id, []):
+            if message["id"] == message_id:
+                return message
+        return not_found("message", message_id)
+
+    # Runs
+    @app.post("/openai/threads/{thread_id}/runs")
+    async def create_run(thread_id: str, request: Request):
+        body = await request.json()
+        if thread_id not in store.threads:
+            return not_found("thread", thread_id)
+        if body["assistant_id"] not in store.assistants:
+            return not_found("assistant", body["assistant_id"])
+        prompts = [message["content"][0]["text"]["value"]
+                   for message in store.messages[thread_id] if message["role"] == "user"]
+        prompt = prompts[-1] if prompts else ""
+        calls_tools = "[tools]" in prompt or store.random.random() < store.scenario.tool_rate
+        run = {"id": new_id("run"), "object": "thread.run", "created_at": int(time.time()),
+               "thread_id": thread_id, "assistant_id": body["assistant_id"], "status": "queued",
+               "required_action": None, "last_error": None, "expires_at": None, "started_at": None,
+               "cancelled_at": None, "failed_at": None, "completed_at": None, "model": "gpt",
+               "instructions": body.get("instructions"), "tools": [], "file_ids": [], "metadata": {},
+               "_prompt": prompt, "_tools": list(store.scenario.tools) if calls_tools else [],
+               "_image": "[image]" in prompt or store.random.random() < store.scenario.image_rate,
+               "_steps": []}
+        schedule(run)
+        store.runs[run["id"]] = run
+        return public(run)
+
+    @app.get("/openai/threads/{thread_id}/runs/{run_id}")
+    async def get_run(thread_id: str, run_id: str):
+        run = store.runs.get(run_id)
+        if run is None:
+            return not_found("run", run_id)
+        advance(run)
+        return public(run)
+
+    @app.post("/openai/threads/{thread_id}/runs/{run_id}/cancel")
+    async def cancel_run(thread_id: str, run_id: str):
+        run = store.runs.get(run_id)
+        if run is None:
+            return not_found("run", run_id)
+        run["status"] = "cancelled"
+        run["cancelled_at"] = int(time.time())
+        return public(run)
+
+    @app.post("/openai/threads/{thread_id}/runs/{run_id}/submit_tool_outputs")
+    async def submit_tool_outputs(thread_id: str, run_id: str, request: Request):
+        run = store.runs.get(run_id)
+        if run is None:
+            return not_found("run", run_id)
+        if run["status"] != "requires_action":
+            return JSONResponse({"error": {"code": "invalid_request", "message": "Run is not waiting for tool outputs"}}, 400)
+        await request.json()
+        for step in run["_steps"]:
+            step["status"] = "completed"
+        run["status"] = "in_progress"
+        run["required_action"] = None
+        schedule(run)
+        return public(run)
+
+    @app.get("/openai/threads/{thread_id}/runs/{run_id}/steps")
+    async def list_steps(thread_id: str, run_id: str, order: str = "desc", after: str | None = None, limit: int = 20):
+        run = store.runs.get(run_id)
+        if run is None:
+            return not_found("run", run_id)
+        return page(run["_steps"], order, after, limit)
+
+    # Files
+    @app.post("/openai/files")
+    async def create_file(file: UploadFile = File(...), purpose: str = Form(...)):
+        data = await file.read()
+        item = {"id": new_id("file"), "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                "filename": file.filename, "purpose": purpose, "status": "processed", "_data": data}
+        store.files[item["id"]] = item
+        return public(item)
+
+    @app.get("/openai/files/{file_id}/content")
+    async def get_file_content(file_id: str):
+        if file_id not in store.files:
+            return not_found("file", file_id)
+        return Response(store.files[file_id]["_data"], media_type="application/octet-stream")
+
+    @app.delete("/openai/files/{file_id}")
+    async def delete_file(file_id: str):
+        store.files.pop(file_id, None)
+        return {"id": file_id, "object": "file", "deleted": True}
+
+    # The documents behind fileURLs, with an ETag so that re-uploads are skipped
+    @app.get("/data/{name}")
+    async def get_data(name: str, request: Request):
+        etag = f'"{name}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304)
+        return Response(f"name,value\n{name},1\n".encode(), media_type="text/csv",
+                        headers={"ETag": etag})
+
+    # Logic Apps
+    @app.post("/email")
+    async def email(request: Request):
+        await request.json()
+        store.emails += 1
+        return Response(status_code=202)
+
+    # Benchmark controls
+    @app.post("/_scenario")
+    async def set_scenario(changes: dict):
+        store.scenario = Scenario(**{**store.scenario.model_dump(), **changes})
+        return store.scenario
+
+    @app.get("/_stats")
+    async def get_stats():
+        return {"scenario": store.scenario, "counts": store.counts, "emails": store.emails,
+                "assistants": len(store.assistants), "threads": len(store.threads),
+                "runs": len(store.runs), "files": len(store.files)}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--seed", type=int)
+    for (name, field) in Scenario.model_fields.items():
+        if field.annotation is list[str]:
+            parser.add_argument(f"--{name.replace('_', '-')}", nargs="*", default=field.default)
+        else:
+            parser.add_argument(f"--{name.replace('_', '-')}", type=field.annotation, default=field.default)
+    args = parser.parse_args()
+
+    import uvicorn
+    scenario = Scenario(**{name: getattr(args, name) for name in Scenario.model_fields})
+    uvicorn.run(create_app(scenario, args.seed), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
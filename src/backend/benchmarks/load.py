@@ -0,0 +1,348 @@
+"""Load test main.app against the fake Assistants API.
+
+Starts benchmarks/fake_openai.py (or uses --fake-url), points the backend at
+it and runs a load profile against main.app in this process, so that the
+event loop lag is the backend's own. Reports the p50/p95/p99 latency and the
+throughput of each route, the status codes and the event loop lag as JSON.
+Run it from src/backend:
+
+    python benchmarks/load.py --profile steady --output load.json
+    python benchmarks/load.py --profile steady --baseline load.json --tolerance 0.2
+    python benchmarks/load.py --profile my-profile.json --tool-rate 0.5 --throttle-rate 0.05
+
+A profile is a built-in name from PROFILES or a JSON file of the same shape.
+Each phase runs concurrency virtual users for duration seconds, every user
+picking the next request from mix. With --baseline the script exits with 1
+when a latency percentile is more than tolerance slower, or the throughput
+more than tolerance lower, than the saved results.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.join(BACKEND, "benchmarks")
+
+PROFILES = {
+    # A quick check that everything works end to end
+    "smoke": {"users": 2, "phases": [
+        {"name": "process", "duration": 5, "concurrency": 2, "mix": {"process": 1}},
+    ]},
+    # Steady traffic from a fixed set of users, with some sign-ups
+    "steady": {"users": 20, "phases": [
+        {"name": "warmup", "duration": 5, "concurrency": 5, "mix": {"process": 1}},
+        {"name": "steady", "duration": 30, "concurrency": 20,
+         "mix": {"process": 0.7, "status": 0.25, "create": 0.05}},
+    ]},
+    # Many users sending prompts at once
+    "burst": {"users": 50, "phases": [
+        {"name": "burst", "duration": 20, "concurrency": 100, "mix": {"process": 0.9, "status": 0.1}},
+    ]},
+}
+
+ROUTES = ("create", "process", "status")
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def summarize(values: list[float]) -> dict:
+    values = sorted(values)
+    summary = {f"p{p}": percentile(values, p) for p in PERCENTILES}
+    summary["max"] = values[-1] if values else None
+    return summary
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {route: [] for route in ROUTES}
+        self.statuses: dict[str, dict[str, int]] = {route: {} for route in ROUTES}
+        self.job_seconds: list[float] = []
+        self.loop_lag: list[float] = []
+
+    def add(self, route: str, seconds: float, status: int | str):
+        self.latencies[route].append(seconds)
+        statuses = self.statuses[route]
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def clear(self, route: str):
+        self.latencies[route].clear()
+        self.statuses[route].clear()
+
+
+async def watch_loop_lag(recorder: Recorder, interval: float = 0.01):
+    # How late the loop wakes a task up is the time other tasks kept it busy
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        recorder.loop_lag.append(max(0.0, loop.time() - start - interval))
+
+
+class LoadTest:
+    def __init__(self, client, fake_url: str, recorder: Recorder, rng: random.Random):
+        self.client = client
+        self.fake_url = fake_url
+        self.recorder = recorder
+        self.random = rng
+        self.users: list[str] = []
+        self.pending_jobs: set[asyncio.Task] = set()
+        self.prefix = f"bench{int(time.time())}"
+        self.created = 0
+
+    async def request(self, route: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except Exception as e:
+            self.recorder.add(route, time.perf_counter() - start, type(e).__name__)
+            return None
+        self.recorder.add(route, time.perf_counter() - start, response.status_code)
+        return response
+
+    async def create(self, wait: bool):
+        self.created += 1
+        user_name = f"{self.prefix}-{self.created}"
+        response = await self.request("create", "POST", "/api/create", json={
+            "userName": user_name, "name": "Benchmark", "instructions": "Answer briefly.",
+            "fileURLs": [f"{self.fake_url}/data/benchmark.csv"]})
+        if response is None or response.status_code != 202:
+            return
+        job = self.wait_for_job(user_name, response.json()["id"], time.perf_counter())
+        if wait:
+            await job
+        else:
+            task = asyncio.create_task(job)
+            self.pending_jobs.add(task)
+            task.add_done_callback(self.pending_jobs.discard)
+
+    async def wait_for_job(self, user_name: str, job_id: str, start: float):
+        while True:
+            response = await self.client.get(f"/api/jobs/{job_id}")
+            if response.status_code == 200 and response.json()["status"] in ("completed", "failed"):
+                break
+            await asyncio.sleep(0.05)
+        self.recorder.job_seconds.append(time.perf_counter() - start)
+        if response.json()["status"] == "completed":
+            self.users.append(user_name)
+
+    async def process(self):
+        if not self.users:
+            return await self.status()
+        user_name = self.random.choice(self.users)
+        await self.request("process", "POST", "/api/process",
+                           json={"userName": user_name, "prompt": "How is the benchmark going?"})
+
+    async def status(self):
+        user_name = self.random.choice(self.users) if self.users else "missing"
+        await self.request("status", "GET", f"/api/status/{user_name}")
+
+    async def user(self, mix: dict, deadline: float, think: float):
+        routes = list(mix)
+        weights = [mix[route] for route in routes]
+        while time.perf_counter() < deadline:
+            route = self.random.choices(routes, weights)[0]
+            if route == "create":
+                await self.create(wait=False)
+            elif route == "process":
+                await self.process()
+            else:
+                await self.status()
+            if think > 0:
+                await asyncio.sleep(self.random.uniform(0, 2 * think))
+
+    async def run(self, profile: dict) -> float:
+        """Create the users, then run the phases and return their total duration."""
+        await asyncio.gather(*[self.create(wait=True) for _ in range(profile.get("users", 0))])
+        # Only the requests of the phases are reported
+        self.recorder.clear("create")
+        start = time.perf_counter()
+        for phase in profile["phases"]:
+            logging.warning(f"Phase {phase.get('name', '')}: {phase['concurrency']} users "
+                            f"for {phase['duration']}s")
+            if "scenario" in phase:
+                await asyncio.to_thread(set_scenario, self.fake_url, phase["scenario"])
+            deadline = time.perf_counter() + phase["duration"]
+            await asyncio.gather(*[self.user(phase["mix"], deadline, phase.get("think", 0))
+                                   for _ in range(phase["concurrency"])])
+        elapsed = time.perf_counter() - start
+        if self.pending_jobs:
+            await asyncio.gather(*self.pending_jobs)
+        return elapsed
+
+
+def set_scenario(fake_url: str, changes: dict):
+    request = urllib.request.Request(f"{fake_url}/_scenario", data=json.dumps(changes).encode(),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    urllib.request.urlopen(request, timeout=5).close()
+
+
+def start_fake(port: int, scenario_args: list[str], timeout: float = 30) -> subprocess.Popen:
+    server = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS, "fake_openai.py"),
+                               "--port", str(port), *scenario_args], cwd=BACKEND)
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/_stats", timeout=1).close()
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        if server.poll() is not None:
+            raise RuntimeError(f"The fake server exited with {server.returncode}")
+        time.sleep(0.05)
+    server.terminate()
+    raise TimeoutError(f"The fake server did not start after {timeout}s")
+
+
+def configure(fake_url: str, workdir: str):
+    """Point the settings at the fake server before main is imported."""
+    os.environ.update({
+        "OPENAI_URI": fake_url,
+        "OPENAI_KEY": "benchmark",
+        "OPENAI_VERSION": "2024-02-15-preview",
+        "OPENAI_GPT_DEPLOYMENT": "benchmark",
+        "EMAIL_URI": f"{fake_url}/email",
+        "QUOTES_FIXTURE": os.path.join(BACKEND, "fixtures", "quotes.json"),
+        "COUNTRIES_SNAPSHOT": os.path.join(workdir, "data", "countries.json"),
+        "DEPLOY_SPA": "False",
+    })
+    # The store and the saved images go to the work directory
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND)
+
+
+async def run_profile(profile: dict, fake_url: str, seed: int | None) -> dict:
+    import httpx
+    import main
+
+    # The backend logs every request at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    recorder = Recorder()
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend", timeout=300) as client:
+            lag = asyncio.create_task(watch_loop_lag(recorder))
+            try:
+                elapsed = await LoadTest(client, fake_url, recorder, random.Random(seed)).run(profile)
+            finally:
+                lag.cancel()
+            stats = (await client.get("/api/stats")).json()
+
+    routes = {}
+    for route in ROUTES:
+        latencies = recorder.latencies[route]
+        if not latencies:
+            continue
+        routes[route] = {"requests": len(latencies), "throughput": len(latencies) / elapsed,
+                         "statuses": recorder.statuses[route], **summarize(latencies)}
+    requests = sum(len(latencies) for latencies in recorder.latencies.values())
+    return {"duration": elapsed, "requests": requests, "throughput": requests / elapsed,
+            "routes": routes, "create_job": summarize(recorder.job_seconds),
+            "loop_lag": summarize(recorder.loop_lag), "backend": stats}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for (route, result) in results["routes"].items():
+        saved = baseline.get("routes", {}).get(route)
+        if saved is None:
+            continue
+        for p in PERCENTILES:
+            (value, before) = (result[f"p{p}"], saved.get(f"p{p}"))
+            if before and value > before * (1 + tolerance):
+                regressions.append(
+                    f"{route} p{p}: {value:.3f}s is slower than the baseline {before:.3f}s")
+    before = baseline.get("throughput")
+    if before and results["throughput"] < before * (1 - tolerance):
+        regressions.append(
+            f"throughput: {results['throughput']:.1f}/s is lower than the baseline {before:.1f}/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profile", default="smoke",
+                        help=f"one of {', '.join(PROFILES)} or a JSON file")
+    parser.add_argument("--fake-url", help="use a fake server that is already running")
+    parser.add_argument("--fake-port", type=int, default=9998)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown over the baseline, 0.2 is 20%%")
+    # Passed on to the fake server
+    for name in ("--run-seconds", "--run-jitter", "--tool-rate", "--image-rate",
+                 "--throttle-rate", "--throttle-ms", "--latency"):
+        parser.add_argument(name)
+    parser.add_argument("--tools", nargs="*")
+    args = parser.parse_args()
+
+    if args.profile in PROFILES:
+        profile = PROFILES[args.profile]
+    else:
+        with open(args.profile) as f:
+            profile = json.load(f)
+    # Read before the work directory is changed
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+
+    scenario_args = []
+    for (name, value) in vars(args).items():
+        if name in ("run_seconds", "run_jitter", "tool_rate", "image_rate",
+                    "throttle_rate", "throttle_ms", "latency") and value is not None:
+            scenario_args += [f"--{name.replace('_', '-')}", value]
+    if args.tools is not None:
+        scenario_args += ["--tools", *args.tools]
+
+    fake = None
+    fake_url = args.fake_url
+    if fake_url is None:
+        fake = start_fake(args.fake_port, scenario_args)
+        fake_url = f"http://127.0.0.1:{args.fake_port}"
+    elif scenario_args:
+        logging.warning("The scenario options are ignored with --fake-url")
+    try:
+        with tempfile.TemporaryDirectory(prefix="commander-bench-") as workdir:
+            configure(fake_url, workdir)
+            results = asyncio.run(run_profile(profile, fake_url, args.seed))
+            os.chdir(BACKEND)
+    finally:
+        if fake is not None:
+            fake.terminate()
+            fake.wait()
+
+    results = {"profile": args.profile, **results}
+    print(json.dumps(results, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Measure how long the backend takes to start.
+
+Reports the median time to import main and the median time from launching
+uvicorn until the first request is answered, as JSON. Run it from src/backend:
+
+    python benchmarks/startup.py --runs 5 --output startup.json
+    python benchmarks/startup.py --baseline startup.json --tolerance 0.2
+
+With --baseline the script exits with 1 when a median is more than
+tolerance slower than the saved one.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+
+def import_time() -> float:
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=BACKEND,
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def first_request_time(port: int, timeout: float) -> float:
+    url = f"http://127.0.0.1:{port}/api/status"
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+                              cwd=BACKEND, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                urllib.request.urlopen(url, timeout=1)
+                return time.perf_counter() - start
+            except urllib.error.HTTPError as e:
+                # A 404 for an empty store still means the app is serving
+                if e.code < 500:
+                    return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with {server.returncode}")
+            time.sleep(0.01)
+        raise TimeoutError(f"No response from {url} after {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for (name, value) in results.items():
+        if name in baseline and value > baseline[name] * (1 + tolerance):
+            regressions.append(
+                f"{name}: {value:.3f}s is slower than the baseline {baseline[name]:.3f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown over the baseline, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    results = {
+        "import_seconds": statistics.median(import_time() for _ in range(args.runs)),
+        "first_request_seconds": statistics.median(
+            first_request_time(args.port, args.timeout) for _ in range(args.runs)),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by TTLCache.get when the key is not cached, so None can be cached
+MISSING = object()
+
+
+class TTLCache:
+    """A bounded LRU cache whose entries expire ttl seconds after they are set.
+
+    Safe to use from the event loop and from the threadpool of the sync routes.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                (expires, value) = item
+                if expires > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,87 @@
+import logging
+
+import settings
+
+# httpx and openai are imported when the clients are built, at app startup
+
+
+def __http2_enabled() -> bool:
+    # HTTP/2 needs the optional h2 package (httpx[http2])
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logging.info("h2 is not installed, using HTTP/1.1 connections")
+        return False
+
+
+def __limits(config: settings.Settings):
+    import httpx
+    return httpx.Limits(max_connections=config.http_max_connections,
+                        max_keepalive_connections=config.http_max_keepalive,
+                        keepalive_expiry=config.http_keepalive_expiry)
+
+
+async_client = None
+http_client = None
+limiter = None
+
+
+def Async():
+    """The shared async Azure OpenAI client used by the async routes.
+
+    Every call goes through the rate limiter and retry layer, so the SDK's
+    own retries are turned off.
+    """
+    global async_client, limiter
+    if async_client is None:
+        import httpx
+        from openai import AsyncAzureOpenAI
+        import ratelimit
+        config = settings.Instance()
+        # Each worker process gets its share of the deployment quota
+        workers = config.web_concurrency
+        limiter = ratelimit.AdaptiveLimiter(config.openai_requests_per_minute / 60 / workers,
+                                            max(1, config.openai_burst // workers),
+                                            max(1, config.openai_max_concurrency // workers),
+                                            max(1, config.openai_min_concurrency // workers))
+        transport = ratelimit.ThrottledTransport(httpx.AsyncHTTPTransport(limits=__limits(config),
+                                                                          http2=__http2_enabled()),
+                                                 limiter, config.openai_retries,
+                                                 config.openai_retry_delay, config.openai_max_retry_delay)
+        pool = httpx.AsyncClient(transport=transport,
+                                 timeout=config.http_timeout)
+        async_client = AsyncAzureOpenAI(api_key=config.api_key,
+                                        api_version=config.api_version,
+                                        azure_endpoint=config.api_endpoint,
+                                        http_client=pool,
+                                        max_retries=0)
+    return async_client
+
+
+def stats() -> dict:
+    """Queue depth and throttling counters of the Azure OpenAI calls."""
+    return {} if limiter is None else limiter.stats()
+
+
+def Http():
+    """The shared pooled HTTP client for downloads from other services."""
+    global http_client
+    if http_client is None:
+        import httpx
+        config = settings.Instance()
+        http_client = httpx.AsyncClient(limits=__limits(config),
+                                        timeout=config.http_timeout,
+                                        follow_redirects=True,
+                                        http2=__http2_enabled())
+    return http_client
+
+
+async def close():
+    global async_client, http_client
+    if async_client is not None:
+        await async_client.close()
+        async_client = None
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
@@ -0,0 +1,221 @@
+import asyncio
+import difflib
+import functools
+import json
+import logging
+import os
+import sys
+import time
+import unicodedata
+
+# Only the fields get_country_data formats, the API allows up to 10
+SOURCE_URL = "https://restcountries.com/v3.1/all?fields=name,cca2,cca3,capital,population,area,region,subregion,altSpellings"
+# How long to wait before downloading again while there is no snapshot (seconds)
+RETRY_DELAY = 60
+# Snapshot shipped with the app, used until a fresh one is downloaded
+SEED_PATH = "fixtures/countries.json"
+FIELDS = ("cca2", "cca3", "name", "official_name", "capital",
+          "population", "area", "region", "subregion")
+
+
+class CountryRecord:
+    __slots__ = FIELDS
+
+    def __init__(self, cca2: str, cca3: str, name: str, official_name: str, capital: str,
+                 population: int, area: float, region: str, subregion: str):
+        self.cca2 = cca2
+        self.cca3 = cca3
+        self.name = name
+        self.official_name = official_name
+        self.capital = capital
+        self.population = population
+        self.area = area
+        self.region = region
+        self.subregion = subregion
+
+    def describe(self) -> str:
+        return f'Country: {self.name}\nCapital: {self.capital}\nPopulation: {self.population}\nArea: {self.area} km²\nRegion: {self.region}\nSubregion: {self.subregion}'
+
+
+def normalize(name: str) -> str:
+    # Case and accent insensitive, "Côte d'Ivoire" matches "cote d'ivoire"
+    name = unicodedata.normalize("NFKD", name.strip().casefold())
+    return "".join(c for c in name if not unicodedata.combining(c))
+
+
+class CountryIndex:
+    """Countries keyed by their names, official names, codes and alternative spellings.
+
+    Exact keys resolve with one dictionary lookup. Anything else falls back
+    to the closest key, and those fuzzy results are cached.
+    """
+
+    def __init__(self, records: list[CountryRecord], aliases: list[list[str]]):
+        self._keys: dict[str, CountryRecord] = {}
+        for (record, names) in zip(records, aliases):
+            for name in (record.cca2, record.cca3, record.name, record.official_name, *names):
+                if name:
+                    self._keys.setdefault(normalize(name), record)
+        self._names = list(self._keys)
+        self.lookup = functools.lru_cache(maxsize=1024)(self.__lookup)
+
+    def __len__(self) -> int:
+        return len(set(map(id, self._keys.values())))
+
+    def __lookup(self, query: str) -> CountryRecord | None:
+        key = normalize(query)
+        record = self._keys.get(key)
+        if record is not None:
+            return record
+        matches = difflib.get_close_matches(key, self._names, n=1, cutoff=0.75)
+        return self._keys[matches[0]] if matches else None
+
+
+def compact(countries: list[dict]) -> dict:
+    """Keep the fields of FIELDS from the restcountries response, one row per country."""
+    rows = []
+    for country in countries:
+        name = country.get("name", {})
+        capital = country.get("capital") or []
+        rows.append([country.get("cca2", ""), country.get("cca3", ""), name.get("common", ""),
+                     name.get("official", ""), ", ".join(capital), country.get("population", 0),
+                     country.get("area", 0), country.get("region", ""), country.get("subregion", ""),
+                     country.get("altSpellings", [])])
+    return {"fields": [*FIELDS, "aliases"], "updated_at": time.time(), "countries": rows}
+
+
+def load(path: str) -> CountryIndex | None:
+    try:
+        with open(path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.error(f"Unable to load the country snapshot {path}: {e}")
+        return None
+    rows = snapshot["countries"]
+    return CountryIndex([CountryRecord(*row[:len(FIELDS)]) for row in rows],
+                        [row[len(FIELDS)] for row in rows])
+
+
+async def download(http_client, path: str):
+    """Fetch the countries and replace the snapshot at path."""
+    response = await http_client.get(SOURCE_URL, headers={"Accept": "application/json"})
+    response.raise_for_status()
+    snapshot = compact(response.json())
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(temp_path, path)
+    logging.info(
+        f"Saved {len(snapshot['countries'])} countries to {path}")
+
+
+index = None
+index_mtime = None
+refresh_lock: asyncio.Lock | None = None
+
+
+def get_index(path: str) -> CountryIndex | None:
+    """The index of the snapshot at path, reloaded when another worker refreshed it.
+
+    Until there is a snapshot at path the seed snapshot is used.
+    """
+    global index, index_mtime
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    if mtime is not None and mtime != index_mtime:
+        loaded = load(path)
+        if loaded is not None:
+            index = loaded
+            index_mtime = mtime
+    if index is None:
+        index = load(SEED_PATH)
+    return index
+
+
+async def refresh(http_client, path: str) -> CountryIndex | None:
+    global refresh_lock
+    if refresh_lock is None:
+        refresh_lock = asyncio.Lock()
+    # Concurrent callers wait for one download
+    async with refresh_lock:
+        if is_stale(path, RETRY_DELAY):
+            await download(http_client, path)
+        return get_index(path)
+
+
+def is_stale(path: str, max_age: float) -> bool:
+    try:
+        return time.time() - os.stat(path).st_mtime > max_age
+    except FileNotFoundError:
+        return True
+
+
+class CountryRefresher:
+    """Downloads the snapshot when it is missing, then again every interval seconds."""
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    def start(self, http_client):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.__refresh(http_client))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def __refresh(self, http_client):
+        while True:
+            # With interval 0 the snapshot is only downloaded when missing
+            max_age = self.interval if self.interval > 0 else float("inf")
+            if is_stale(self.path, max_age):
+                try:
+                    await refresh(http_client, self.path)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.warning(
+                        f"Unable to refresh the country snapshot: {e}")
+            if not os.path.exists(self.path):
+                await asyncio.sleep(RETRY_DELAY)
+            elif self.interval > 0:
+                await asyncio.sleep(self.interval)
+            else:
+                return
+
+
+refresher = None
+
+
+def Instance() -> CountryRefresher:
+    global refresher
+    if refresher is None:
+        import settings
+        config = settings.Instance()
+        refresher = CountryRefresher(config.countries_snapshot,
+                                     config.countries_refresh_interval)
+    return refresher
+
+
+if __name__ == "__main__":
+    # Build the snapshot ahead of time: python countries.py [data/countries.json]
+    import httpx
+
+    async def main(path: str):
+        async with httpx.AsyncClient(follow_redirects=True, timeout=60) as http_client:
+            await download(http_client, path)
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "data/countries.json"))
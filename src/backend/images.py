@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from cache import MISSING, TTLCache
+import kvstore
+import settings
+
+ROOT = "wwwroot/images"
+# File ids never change, so neither does the image behind a URL
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Accesses closer together than this are not written to the index again (seconds)
+ACCESS_RESOLUTION = 60
+# Images evicted per round trip to the index
+EVICTION_BATCH = 100
+
+
+def url(user_id: str, file_id: str) -> str:
+    return f"images/{user_id}/{file_id}.png"
+
+
+def etag(file_id: str) -> str:
+    return f'"{file_id}"'
+
+
+def matches(if_none_match: str | None, file_id: str) -> bool:
+    """Whether an If-None-Match header names the image."""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag(file_id) in tags
+
+
+class ImageStore:
+    """Keeps the images of the responses on disk within a byte quota.
+
+    Every saved image is recorded in the kvstore with its size and last
+    access. Once the images take more than quota bytes the least recently
+    used ones are deleted from disk. Their rows are kept, so a request for
+    an evicted image downloads it again from the Files API.
+    """
+
+    def __init__(self, root: str, quota: int):
+        self.root = root
+        self.quota = quota
+        self.downloaded = 0
+        self.evicted = 0
+        # Images being downloaded, so concurrent requests for one file id share the download
+        self._downloads: dict[str, asyncio.Task] = {}
+        self._accessed = TTLCache(10000, ACCESS_RESOLUTION)
+        self._eviction: asyncio.Lock | None = None
+        self._task: asyncio.Task | None = None
+        self._started = 0.0
+
+    def start(self):
+        self._started = time.time()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.__index_existing())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def path(self, user_id: str, file_id: str) -> str:
+        return os.path.join(self.root, user_id, f"{file_id}.png")
+
+    def find(self, user_id: str, file_id: str) -> kvstore.ImageItem | None:
+        """The index entry of an image saved for the user, evicted or not.
+
+        An image on disk that is not indexed yet, e.g. one saved before the
+        index existed, is indexed on the spot.
+        """
+        image = kvstore.get_image(file_id)
+        if image is None:
+            image = self.__index_file(user_id, file_id)
+        if image is None or image.user_id != user_id:
+            return None
+        return image
+
+    def touch(self, file_id: str):
+        if self._accessed.get(file_id) is MISSING:
+            kvstore.touch_image(file_id, time.time())
+            self._accessed.set(file_id, True)
+
+    async def save(self, client, user_id: str, file_id: str, semaphore: asyncio.Semaphore | None = None) -> bool:
+        """Make sure the image is on disk, downloading it when it is missing."""
+        if os.path.exists(self.path(user_id, file_id)):
+            self.touch(file_id)
+            return True
+        download = self._downloads.get(file_id)
+        if download is None:
+            download = asyncio.create_task(
+                self.__download(client, user_id, file_id, semaphore))
+            self._downloads[file_id] = download
+            download.add_done_callback(
+                lambda _: self._downloads.pop(file_id, None))
+        try:
+            await asyncio.shield(download)
+            return True
+        except Exception as e:
+            logging.error(f"Unable to save image {file_id}: {e}")
+            return False
+
+    async def delete_user(self, user_id: str):
+        await asyncio.to_thread(shutil.rmtree, os.path.join(self.root, user_id), ignore_errors=True)
+        kvstore.delete_images(user_id)
+
+    def stats(self) -> dict:
+        return {"bytes": kvstore.image_usage(), "quota": self.quota,
+                "downloaded": self.downloaded, "evicted": self.evicted}
+
+    async def __download(self, client, user_id: str, file_id: str, semaphore: asyncio.Semaphore | None):
+        full_file_path = self.path(user_id, file_id)
+        os.makedirs(os.path.dirname(full_file_path), exist_ok=True)
+        # Stream the image to a temporary file and move it in place once complete
+        temp_file_path = f"{full_file_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(1)
+            async with semaphore:
+                async with client.files.with_streaming_response.content(file_id) as response:
+                    with open(temp_file_path, "wb") as f:
+                        async for chunk in response.iter_bytes():
+                            f.write(chunk)
+            os.replace(temp_file_path, full_file_path)
+        finally:
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+        kvstore.record_image(file_id, user_id,
+                             os.path.getsize(full_file_path), time.time())
+        self._accessed.set(file_id, True)
+        self.downloaded += 1
+        logging.info(f"Saved image to {full_file_path}")
+        await self.__evict()
+
+    async def __evict(self):
+        if self.quota <= 0:
+            return
+        if self._eviction is None:
+            self._eviction = asyncio.Lock()
+        async with self._eviction:
+            usage = kvstore.image_usage()
+            while usage > self.quota:
+                images = kvstore.least_recent_images(EVICTION_BATCH)
+                if images == []:
+                    break
+                evicted = []
+                for image in images:
+                    if usage <= self.quota:
+                        break
+                    evicted.append(image)
+                    usage -= image.size
+                await asyncio.to_thread(self.__remove, [self.path(image.user_id, image.file_id)
+                                                        for image in evicted])
+                kvstore.evict_images([image.file_id for image in evicted])
+                for image in evicted:
+                    self._accessed.pop(image.file_id)
+                self.evicted += len(evicted)
+                logging.info(
+                    f"Evicted {len(evicted)} image(s) to stay within {self.quota} bytes")
+
+    def __remove(self, paths: list[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def __index_existing(self):
+        # Images saved before the index existed, or changed while the app was stopped
+        try:
+            found = await asyncio.to_thread(self.__scan)
+            for image in kvstore.get_stored_images():
+                # Images saved since the start are not in the scan
+                if found.pop((image.user_id, image.file_id), None) is None and image.accessed_at < self._started:
+                    kvstore.evict_images([image.file_id])
+            for ((user_id, file_id), (size, mtime)) in found.items():
+                kvstore.record_image(file_id, user_id, size, mtime)
+            if found:
+                logging.info(f"Indexed {len(found)} existing image(s)")
+            await self.__evict()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Unable to index the saved images: {e}")
+
+    def __index_file(self, user_id: str, file_id: str) -> kvstore.ImageItem | None:
+        # Only plain names, the ids come from the request path
+        if any(name in ("", ".", "..") or os.sep in name for name in (user_id, file_id)):
+            return None
+        try:
+            stat = os.stat(self.path(user_id, file_id))
+        except OSError:
+            return None
+        kvstore.record_image(file_id, user_id, stat.st_size, stat.st_mtime)
+        return kvstore.get_image(file_id)
+
+    def __scan(self) -> dict[tuple[str, str], tuple[int, float]]:
+        found = {}
+        if not os.path.isdir(self.root):
+            return found
+        for user_id in os.listdir(self.root):
+            folder = os.path.join(self.root, user_id)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                if name.endswith(".tmp"):
+                    # Left over by a download that was interrupted
+                    if os.stat(path).st_mtime < self._started:
+                        os.remove(path)
+                elif name.endswith(".png"):
+                    stat = os.stat(path)
+                    found[(user_id, name.removesuffix(".png"))] = (
+                        stat.st_size, stat.st_mtime)
+        return found
+
+
+store = None
+
+
+def Instance() -> ImageStore:
+    global store
+    if store is None:
+        config = settings.Instance()
+        store = ImageStore(ROOT, config.image_cache_bytes)
+    return store
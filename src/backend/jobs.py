@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+import clients
+import kvstore
+import playground
+import settings
+from models import AssistantCreateRequest, AssistantCreateResponse
+
+
+async def delete_user(client, user_name: str) -> bool:
+    """Delete the user's Assistant objects and store entries.
+
+    Returns False if the user was not found.
+    """
+    error = await playground.delete_assistant(client, user_name)
+    if error is not None:
+        return False
+    # Delete the KVStore entries for the user
+    return kvstore.del_user(user_name) > 0
+
+
+async def create_assistant(client, request: AssistantCreateRequest) -> AssistantCreateResponse:
+    """Upload the files and create the user's Assistant and thread.
+
+    Raises ValueError when none of the files could be loaded or the
+    Assistant could not be created.
+    """
+    # Create the files
+    (file_ids, failed_file_urls) = await playground.create_files(
+        client, request.userName, request.fileURLs)
+    if file_ids == []:
+        raise ValueError(
+            f"Unable to load the files: {', '.join(failed_file_urls)}")
+
+    # Create the Assistant and the thread for the user
+    (assistant_id, thread_id, tools) = await playground.create_assistant(client,
+                                                                   request.userName, request.name, request.instructions, file_ids, settings.Instance().api_deployment_name)
+    if assistant_id is None or thread_id is None:
+        raise ValueError("Unable to create the assistant")
+
+    return AssistantCreateResponse(userName=request.userName, name=request.name,
+                                   instructions=request.instructions, tools=tools,
+                                   assistant_id=assistant_id,
+                                   thread_id=thread_id, file_ids=file_ids,
+                                   failed_file_urls=failed_file_urls)
+
+
+class JobRunner:
+    """Runs the long jobs in the background and records their progress in the kvstore.
+
+    A worker claims a job before running it and renews its lease while it
+    runs, so each job runs in one worker process at a time. Jobs left
+    queued, or running under a lease that was not renewed for lease seconds
+    (the worker stopped or crashed), are resumed by any worker from the
+    progress that was recorded.
+    """
+
+    def __init__(self, teardown_concurrency: int, create_workers: int, lease: float):
+        self.teardown_concurrency = teardown_concurrency
+        self.create_workers = create_workers
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._workers: list[asyncio.Task] = []
+        self._queue: asyncio.Queue | None = None
+        # Create jobs in the queue or being run by this worker
+        self._queued: set[str] = set()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self.__work())
+                         for _ in range(self.create_workers)]
+        self._workers.append(asyncio.create_task(self.__keep_leases()))
+
+    async def stop(self):
+        # Unfinished jobs keep their state and are resumed by another worker or on the next start
+        tasks = list(self._tasks.values()) + self._workers
+        self._workers = []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        kvstore.release_jobs(self.owner)
+
+    def create_assistant(self, request: AssistantCreateRequest) -> kvstore.JobItem | None:
+        """Queue the creation of the user's Assistant.
+
+        While a create job for the user is queued or running, that job is
+        returned instead of queueing another one.
+        """
+        job = kvstore.find_unfinished_job("create", request.userName)
+        if job is not None:
+            return job
+        job = kvstore.create_job(
+            "create", request.userName, request.model_dump_json())
+        if job is not None:
+            self.__enqueue(job.id)
+        return job
+
+    def delete_all(self) -> kvstore.JobItem | None:
+        """Start deleting the Assistants of all users, or return the job already doing it."""
+        job = kvstore.find_unfinished_job("delete_all")
+        if job is not None:
+            return job
+        usernames = [user.username for user in kvstore.get_all_user()]
+        job = kvstore.create_job("delete_all", items=usernames)
+        if job is not None and self.__claim(job.id):
+            self.__launch(job.id, self.__delete_all(job.id))
+        return job
+
+    def __launch(self, job_id: str, job):
+        task = asyncio.create_task(job)
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    def __enqueue(self, job_id: str):
+        if job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    def __claim(self, job_id: str) -> bool:
+        now = time.time()
+        return kvstore.claim_job(job_id, self.owner, now, now - self.lease)
+
+    async def __keep_leases(self):
+        while True:
+            now = time.time()
+            kvstore.renew_jobs(self.owner, now)
+            # Pick up the jobs that no live worker holds
+            for job_id in kvstore.get_claimable_jobs("create", now - self.lease):
+                self.__enqueue(job_id)
+            for job_id in kvstore.get_claimable_jobs("delete_all", now - self.lease):
+                if job_id not in self._tasks and self.__claim(job_id):
+                    logging.info(
+                        f"Resuming job {job_id} with {len(kvstore.get_pending_job_items(job_id))} user(s) left")
+                    self.__launch(job_id, self.__delete_all(job_id))
+            await asyncio.sleep(self.lease / 3)
+
+    async def __work(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                # Another worker may have claimed it first
+                if self.__claim(job_id):
+                    await self.__create_assistant(job_id)
+            finally:
+                self._queued.discard(job_id)
+                self._queue.task_done()
+
+    async def __create_assistant(self, job_id: str):
+        try:
+            request = AssistantCreateRequest.model_validate_json(
+                kvstore.get_job_payload(job_id))
+            response = await create_assistant(clients.Async(), request)
+        except asyncio.CancelledError:
+            raise
+        except ValueError as e:
+            kvstore.set_job_status(job_id, "failed", error=str(e))
+            return
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e}")
+            kvstore.set_job_status(job_id, "failed", error="Unable to create the assistant")
+            return
+        kvstore.set_job_status(job_id, "completed",
+                               result=response.model_dump_json())
+
+    async def __delete_all(self, job_id: str):
+        client = clients.Async()
+        semaphore = asyncio.Semaphore(self.teardown_concurrency)
+
+        async def delete(user_name: str):
+            async with semaphore:
+                try:
+                    # A user that is already gone counts as deleted
+                    await delete_user(client, user_name)
+                    ok = True
+                except Exception as e:
+                    logging.error(f"Unable to delete user {user_name}: {e}")
+                    ok = False
+                kvstore.finish_job_item(job_id, user_name, ok)
+
+        try:
+            await asyncio.gather(*[delete(user_name)
+                                   for user_name in kvstore.get_pending_job_items(job_id)])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e}")
+            kvstore.set_job_status(job_id, "failed", error=str(e))
+            return
+        kvstore.set_job_status(job_id, "completed")
+        job = kvstore.get_job(job_id)
+        logging.info(
+            f"Job {job_id} deleted {job.done} user(s), {job.failed} failed")
+
+
+runner = None
+
+
+def Instance() -> JobRunner:
+    global runner
+    if runner is None:
+        config = settings.Instance()
+        runner = JobRunner(config.teardown_concurrency,
+                           config.create_workers, config.job_lease)
+    return runner
@@ -1,8 +1,14 @@
 import logging
 import sqlite3
 import json
+import threading
+import time
 import uuid
+from contextlib import contextmanager
 from pydantic import BaseModel
+from cache import MISSING, TTLCache
+import metrics
+import settings
 
 
 class KVStoreItem(BaseModel):
@@ -11,123 +17,347 @@ class KVStoreItem(BaseModel):
     value: str
 
 
-conn = sqlite3.connect("data/kvstore.db", check_same_thread=False)
-
-
-def create_store():
-    conn.execute(
-        "CREATE TABLE IF NOT EXISTS kvstore (username text, key text, value text)")
-    conn.execute(
-        "CREATE UNIQUE INDEX IF NOT EXISTS kvstore_index ON kvstore (username, key, value)")
-
-
-def __read_value(username, key) -> KVStoreItem | None:
+# Opened by create_store() when the app starts
+conn = None
+
+# Writes are serialized and grouped into transactions, see transaction()
+lock = threading.RLock()
+local = threading.local()
+
+# Read-through cache for the per-user lookups on the prompt path
+config = settings.Instance()
+cache = TTLCache(config.kvstore_cache_size, config.kvstore_cache_ttl)
+CACHED_KEYS = ("id", "assistant", "thread", "cursor")
+# PRAGMA data_version the cache was filled at, it changes when another worker commits
+cache_version = None
+
+
+def create_store(path: str = "data/kvstore.db"):
+    global conn
+    if conn is None:
+        conn = sqlite3.connect(path, check_same_thread=False)
+    # Write-ahead logging lets readers run while a transaction commits
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")
+    with transaction():
+        # Every worker sets up the store on start, take the write lock first so
+        # they run the schema checks and migrations one after the other
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users (username text PRIMARY KEY, id text NOT NULL, name text, instructions text, tools text)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS assistants (username text PRIMARY KEY, assistant_id text NOT NULL)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS assistants_assistant_id ON assistants (assistant_id)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS threads (username text PRIMARY KEY, thread_id text NOT NULL, last_message_id text)")
+        __add_column("threads", "last_message_id", "text")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS threads_thread_id ON threads (thread_id)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (username text NOT NULL, file_id text NOT NULL, name text, PRIMARY KEY (username, file_id))")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS files_file_id ON files (file_id)")
+        # Content-addressed index of the uploaded files, shared by all users
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes (sha256 text PRIMARY KEY, file_id text NOT NULL, refs integer NOT NULL)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS file_hashes_file_id ON file_hashes (file_id)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_urls (url text PRIMARY KEY, etag text, last_modified text, sha256 text NOT NULL)")
+        # Assistants shared by the users with the same configuration
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS assistant_pool (fingerprint text PRIMARY KEY, assistant_id text NOT NULL, refs integer NOT NULL)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS assistant_pool_assistant_id ON assistant_pool (assistant_id)")
+        # Background jobs and, for the bulk jobs, the progress of each user
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id text PRIMARY KEY, kind text NOT NULL, username text, status text NOT NULL, total integer NOT NULL, done integer NOT NULL, failed integer NOT NULL, payload text, result text, error text, created_at real NOT NULL, updated_at real NOT NULL, owner text, heartbeat real)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_kind_status ON jobs (kind, status)")
+        # The worker running a job and when it last renewed its lease, added after the table
+        __add_column("jobs", "owner", "text")
+        __add_column("jobs", "heartbeat", "real")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_items (job_id text NOT NULL, username text NOT NULL, status text NOT NULL, PRIMARY KEY (job_id, username))")
+        # Emails sent by the send_email tool, delivered in the background
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (id integer PRIMARY KEY AUTOINCREMENT, email_url text NOT NULL, recipient text NOT NULL, content text NOT NULL, status text NOT NULL, attempts integer NOT NULL, next_attempt_at real NOT NULL, last_error text, created_at real NOT NULL, sent_at real, owner text, claimed_at real)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_status_next_attempt_at ON outbox (status, next_attempt_at)")
+        # The worker sending an email and when it claimed it, added after the table
+        __add_column("outbox", "owner", "text")
+        __add_column("outbox", "claimed_at", "real")
+        # The worker running prompts on a thread and when it last renewed its lock
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS thread_locks (thread_id text PRIMARY KEY, owner text NOT NULL, heartbeat real NOT NULL)")
+        # Empty threads created ahead of time, claimed by new users
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS thread_pool (thread_id text PRIMARY KEY, created_at real NOT NULL)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS thread_pool_created_at ON thread_pool (created_at)")
+        # Pooled threads being created, so that the workers refilling the pool don't overshoot it
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS thread_pool_reservations (id integer PRIMARY KEY AUTOINCREMENT, reserved_at real NOT NULL)")
+        # Access index of the response images saved on disk, stored is 0 once evicted
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS images (file_id text PRIMARY KEY, user_id text NOT NULL, size integer NOT NULL, stored integer NOT NULL, accessed_at real NOT NULL)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS images_stored_accessed_at ON images (stored, accessed_at)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS images_user_id ON images (user_id)")
+        __migrate_kvstore()
+        # References added twice for one owner by earlier versions
+        conn.execute(
+            "UPDATE file_hashes SET refs=(SELECT COUNT(*) FROM files WHERE files.file_id=file_hashes.file_id) WHERE EXISTS (SELECT 1 FROM files WHERE files.file_id=file_hashes.file_id)")
+
+
+def __add_column(table: str, column: str, type: str):
+    # Add a column that was introduced after the table was created
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        try:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {type}")
+        except sqlite3.OperationalError as e:
+            # Added by another worker in the meantime
+            if "duplicate column name" not in str(e):
+                raise
+
+
+def __migrate_kvstore():
+    # Move the rows of the original (username, key, value) table into the typed tables
+    legacy = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='kvstore'").fetchone()
+    if legacy is None:
+        return
+    rows = conn.execute("SELECT username, key, value FROM kvstore").fetchall()
+    users = {}
+    for (username, key, value) in rows:
+        users.setdefault(username, {"file": []})
+        if key == "file":
+            users[username]["file"].append(json.loads(value))
+        else:
+            users[username][key] = value
+    for (username, values) in users.items():
+        if "id" in values:
+            __upsert_value("users", {"username": username, "id": values["id"], "name": values.get("name"),
+                                     "instructions": values.get("instructions"), "tools": values.get("tools")})
+        if "assistant" in values:
+            __upsert_value("assistants", {"username": username,
+                                          "assistant_id": values["assistant"]})
+        if "thread" in values:
+            __upsert_value("threads", {"username": username,
+                                       "thread_id": values["thread"]})
+        for file in values["file"]:
+            __upsert_value("files", {"username": username,
+                                     "file_id": file["id"], "name": file["name"]})
+    # Keep the original rows around until the migration is verified
+    conn.execute("ALTER TABLE kvstore RENAME TO kvstore_v1")
+    logging.info(f"Migrated {len(rows)} kvstore rows for {len(users)} users")
+
+
+@contextmanager
+def transaction():
+    """Group the writes in the block into a single commit.
+
+    Transactions can be nested, only the outermost one commits. The writes
+    are rolled back if the block raises.
+    """
+    with lock:
+        depth = getattr(local, "depth", 0)
+        local.depth = depth + 1
+        try:
+            yield conn
+            if depth == 0:
+                with metrics.timed("kvstore"):
+                    conn.commit()
+        except:
+            if depth == 0:
+                conn.rollback()
+                # The cache may hold values from the rolled back writes
+                cache.clear()
+            raise
+        finally:
+            local.depth = depth
+
+
+def __read_value(query: str, params: tuple) -> tuple | None:
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT username, key, value FROM kvstore WHERE username=? AND key=?",
-                       (username, key))
-        result = cursor.fetchone()
-        kv = KVStoreItem(username=result[0], key=result[1], value=result[2])
-        if result is None:
-            return None
-        return kv
+        with metrics.timed("kvstore"):
+            cursor.execute(query, params)
+            return cursor.fetchone()
     except:
-        logging.error(f"Failed to set value for {username} {key}")
+        logging.error(f"Failed to read value for {params}")
         return None
     finally:
         cursor.close()
 
 
-def __read_values(username: str, key: str) -> list[KVStoreItem]:
+def __read_values(query: str, params: tuple) -> list[tuple]:
     cursor = conn.cursor()
     try:
-        if key == None:
-            cursor.execute(
-                "SELECT username, key, value FROM kvstore WHERE username=?", (username,))
-        else:
-            cursor.execute("SELECT username, key, value FROM kvstore WHERE username=? AND key=?",
-                           (username, key))
-        result = cursor.fetchall()
-        if result is None:
-            return []
-
-        kv_list = []
-        for row in result:
-            kv_list.append(KVStoreItem(
-                username=row[0], key=row[1], value=row[2]))
-
-        cursor.close()
-
-        return kv_list
+        with metrics.timed("kvstore"):
+            cursor.execute(query, params)
+            return cursor.fetchall()
     except:
-        logging.error(f"Failed to read value for {username} {key}")
+        logging.error(f"Failed to read values for {params}")
         return []
     finally:
         cursor.close()
 
 
-def __upsert_value(username: str, key: str, value: str) -> KVStoreItem:
-    cursor = conn.cursor()
+def __invalidate(username: str):
+    for key in CACHED_KEYS:
+        cache.pop((username, key))
+
+
+def __check_cache():
+    # The writes of this worker invalidate their keys, the ones of other workers the whole cache
+    global cache_version
     try:
-        if key != "file":
-            cursor.execute("DELETE from kvstore WHERE username=? and key=?",
-                           (username, key))
-        else:
-            cursor.execute("DELETE from kvstore WHERE username=? and key=? and value=?",
-                           (username, key, value))
-        cursor.execute("INSERT INTO kvstore VALUES (?, ?, ?)",
-                       (username, key, value))
-        conn.commit()
-        logging.info(f"Value set: {username} {key} {value}")
-        return KVStoreItem(username=username, key=key, value=value)
-    except:
-        logging.error(f"Failed to set value for {username} {key} {value}")
-        return None
-    finally:
-        cursor.close()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+    except:
+        version = None
+    if version is None or version != cache_version:
+        cache.clear()
+        cache_version = version
+
+
+def evict_user(username: str):
+    """Drop the cached lookups of the user, e.g. after the API reported its objects missing."""
+    __invalidate(username)
+
+
+def __cached_value(username: str, key: str, read) -> KVStoreItem | None:
+    __check_cache()
+    item = cache.get((username, key))
+    if item is MISSING:
+        item = read()
+        # Misses and read errors are not cached, another worker may add the value
+        if item is not None:
+            cache.set((username, key), item)
+    return item
+
+
+def __upsert_value(table: str, row: dict):
+    # Raises on failure so that the enclosing transaction is rolled back
+    if "username" in row:
+        __invalidate(row["username"])
+    columns = ", ".join(row.keys())
+    placeholders = ", ".join("?" for _ in row)
+    with transaction():
+        conn.execute(f"INSERT OR REPLACE INTO {table} ({columns}) VALUES ({placeholders})",
+                     tuple(row.values()))
+    logging.info(f"Value set: {table} {row}")
 
 
 def __delete_value(username: str) -> int:
-    cursor = conn.cursor()
+    __invalidate(username)
     try:
-        cursor.execute("DELETE FROM kvstore WHERE username=?", (username,))
-        conn.commit()
-        logging.info(f"For user {username} Deleted {cursor.rowcount} rows")
-        return conn.total_changes
+        count = 0
+        with transaction():
+            for table in ("users", "assistants", "threads", "files"):
+                count += conn.execute(f"DELETE FROM {table} WHERE username=?",
+                                      (username,)).rowcount
+        logging.info(f"For user {username} Deleted {count} rows")
+        return count
     except:
         logging.info(f"Unable to delete the values for {username}")
         return -1
-    finally:
-        cursor.close()
 
 
 def create_assistant(user_name: str, name: str, instructions: str, tools: str, assistant_id: str) -> KVStoreItem:
-    # This id will be used to create an images folder
-    __upsert_value(user_name, "id", str(uuid.uuid4()))
-    # The assistant name
-    __upsert_value(user_name, "name", name)
-    # The assistant instructions
-    __upsert_value(user_name, "instructions", instructions)
-    # The assistant tools
-    __upsert_value(user_name, "tools", tools)
-    # The assistant id
-    return __upsert_value(user_name, "assistant", assistant_id)
+    try:
+        # Write the whole assistant record in one commit
+        with transaction():
+            # The id will be used to create an images folder
+            __upsert_value("users", {"username": user_name, "id": str(uuid.uuid4()), "name": name,
+                                     "instructions": instructions, "tools": tools})
+            __upsert_value("assistants", {"username": user_name,
+                                          "assistant_id": assistant_id})
+        return KVStoreItem(username=user_name, key="assistant", value=assistant_id)
+    except:
+        logging.error(f"Failed to set the assistant for {user_name}")
+        return None
 
 
 def get_user_id(username: str) -> KVStoreItem | None:
-    return __read_value(username, "id")
+    return __cached_value(username, "id", lambda: __get_user_id(username))
+
+
+def __get_user_id(username: str) -> KVStoreItem | None:
+    result = __read_value(
+        "SELECT id FROM users WHERE username=?", (username,))
+    if result is None:
+        return None
+    return KVStoreItem(username=username, key="id", value=result[0])
 
 
 def get_assistant(username: str) -> KVStoreItem | None:
-    return __read_value(username, "assistant")
+    return __cached_value(username, "assistant", lambda: __get_assistant(username))
+
+
+def __get_assistant(username: str) -> KVStoreItem | None:
+    result = __read_value(
+        "SELECT assistant_id FROM assistants WHERE username=?", (username,))
+    if result is None:
+        return None
+    return KVStoreItem(username=username, key="assistant", value=result[0])
 
 
 def create_thread(username: str, thread_id: str) -> KVStoreItem | None:
-    return __upsert_value(username, "thread", thread_id)
+    try:
+        __upsert_value("threads", {"username": username, "thread_id": thread_id})
+        return KVStoreItem(username=username, key="thread", value=thread_id)
+    except:
+        logging.error(f"Failed to set the thread for {username}")
+        return None
 
 
 def get_thread(username: str) -> KVStoreItem | None:
-    return __read_value(username, "thread")
+    return __cached_value(username, "thread", lambda: __get_thread(username))
+
+
+def __get_thread(username: str) -> KVStoreItem | None:
+    result = __read_value(
+        "SELECT thread_id FROM threads WHERE username=?", (username,))
+    if result is None:
+        return None
+    return KVStoreItem(username=username, key="thread", value=result[0])
+
+
+def get_thread_cursor(username: str) -> str | None:
+    """The id of the last thread message returned to the user."""
+    item = __cached_value(username, "cursor",
+                          lambda: __get_thread_cursor(username))
+    return item.value if item is not None else None
+
+
+def __get_thread_cursor(username: str) -> KVStoreItem | None:
+    result = __read_value(
+        "SELECT last_message_id FROM threads WHERE username=?", (username,))
+    if result is None or result[0] is None:
+        return None
+    return KVStoreItem(username=username, key="cursor", value=result[0])
+
+
+def set_thread_cursor(username: str, message_id: str):
+    try:
+        with transaction():
+            updated = conn.execute("UPDATE threads SET last_message_id=? WHERE username=?",
+                                   (message_id, username)).rowcount
+    except:
+        cache.pop((username, "cursor"))
+        logging.error(f"Failed to set the thread cursor for {username}")
+        return
+    # Only the cursor changed, the other cached lookups stay valid
+    if updated:
+        cache.set((username, "cursor"), KVStoreItem(
+            username=username, key="cursor", value=message_id))
 
 
 def create_files(username: str, file_urls: list[(str, str)]) -> KVStoreItem | None:
@@ -137,50 +367,589 @@ def create_files(username: str, file_urls: list[(str, str)]) -> KVStoreItem | No
     if file_urls is None or file_urls == []:
         logging.error("create_files, No file urls provided")
         return []
-    for (file_name, id) in file_urls:
-        fileData = json.dumps({"name": file_name, "id": id})
-        __upsert_value(username, "file", fileData)
+    try:
+        with transaction():
+            for (file_name, id) in file_urls:
+                __upsert_value("files", {"username": username,
+                                         "file_id": id, "name": file_name})
+    except:
+        logging.error(f"Failed to set the files for {username}")
+
+
+def __file_item(username: str, file_id: str, name: str) -> KVStoreItem:
+    return KVStoreItem(username=username, key="file", value=json.dumps({"name": name, "id": file_id}))
 
 
 def get_files(username: str) -> list[KVStoreItem]:
-    return __read_values(username, "file")
+    rows = __read_values(
+        "SELECT file_id, name FROM files WHERE username=?", (username,))
+    return [__file_item(username, file_id, name) for (file_id, name) in rows]
 
 
 def delete_file(username: str, file_id: str) -> int:
-    return __delete_value(username, file_id)
+    try:
+        with transaction():
+            return conn.execute("DELETE FROM files WHERE username=? AND file_id=?",
+                                (username, file_id)).rowcount
+    except:
+        logging.error(f"Unable to delete file {file_id} for {username}")
+        return -1
 
 
-def get_all_user() -> list[KVStoreItem]:
-    cursor = conn.cursor()
+class FileUrlItem(BaseModel):
+    url: str
+    etag: str | None
+    last_modified: str | None
+    sha256: str
+
+
+def get_file_url(url: str) -> FileUrlItem | None:
+    result = __read_value(
+        "SELECT url, etag, last_modified, sha256 FROM file_urls WHERE url=?", (url,))
+    if result is None:
+        return None
+    return FileUrlItem(url=result[0], etag=result[1], last_modified=result[2], sha256=result[3])
+
+
+def set_file_url(url: str, etag: str | None, last_modified: str | None, sha256: str):
     try:
-        cursor.execute(
-            "SELECT username, key, value FROM kvstore where key='name'")
-        result = cursor.fetchall()
-        if result is None:
-            return []
+        __upsert_value("file_urls", {"url": url, "etag": etag,
+                                     "last_modified": last_modified, "sha256": sha256})
+    except:
+        logging.error(f"Failed to set the file url {url}")
 
-        kv_list = []
-        for row in result:
-            kv_list.append(KVStoreItem(
-                username=row[0], key=row[1], value=row[2]))
 
-        cursor.close()
-        return kv_list
+def acquire_file(sha256: str, username: str, name: str, file_id: str | None = None) -> str | None:
+    """Give the user the file with this content and return its id.
+
+    If the content is not indexed yet, file_id is registered for it. The
+    user's file entry and its reference are added in one commit, and only
+    once per user, so refs always matches the number of owners. Returns
+    None when the content is unknown and no file_id was given.
+    """
+    try:
+        with transaction():
+            result = conn.execute("SELECT file_id FROM file_hashes WHERE sha256=?",
+                                  (sha256,)).fetchone()
+            if result is None:
+                if file_id is None:
+                    return None
+                conn.execute("INSERT INTO file_hashes VALUES (?, ?, 0)",
+                             (sha256, file_id))
+            else:
+                file_id = result[0]
+            __invalidate(username)
+            added = conn.execute("INSERT OR IGNORE INTO files (username, file_id, name) VALUES (?, ?, ?)",
+                                 (username, file_id, name)).rowcount
+            if added:
+                conn.execute("UPDATE file_hashes SET refs=refs+1 WHERE sha256=?",
+                             (sha256,))
+            return file_id
     except:
-        logging.error(f"Failed to read value for {username} {key}")
+        logging.error(f"Failed to acquire the file for {sha256}")
+        return None
+
+
+def release_file(file_id: str, username: str | None = None) -> int:
+    """Drop a reference to the file and return the references left.
+
+    When username is given the user's file entry is removed in the same
+    commit, so an interrupted teardown never releases the file twice.
+    Returns -1 if the file is not in the index.
+    """
+    try:
+        with transaction():
+            if username is not None:
+                __invalidate(username)
+                conn.execute("DELETE FROM files WHERE username=? AND file_id=?",
+                             (username, file_id))
+            result = conn.execute("SELECT refs FROM file_hashes WHERE file_id=?",
+                                  (file_id,)).fetchone()
+            if result is None:
+                return -1
+            refs = result[0] - 1
+            if refs > 0:
+                conn.execute("UPDATE file_hashes SET refs=? WHERE file_id=?",
+                             (refs, file_id))
+            else:
+                conn.execute("DELETE FROM file_hashes WHERE file_id=?",
+                             (file_id,))
+            return max(refs, 0)
+    except:
+        logging.error(f"Failed to release the file {file_id}")
+        return -1
+
+
+def acquire_assistant(fingerprint: str, assistant_id: str | None = None) -> str | None:
+    """Add a reference to the pooled assistant with this fingerprint and return its id.
+
+    If there is no pooled assistant yet, assistant_id is registered for it.
+    Returns None when the fingerprint is unknown and no assistant_id was given.
+    """
+    try:
+        with transaction():
+            updated = conn.execute("UPDATE assistant_pool SET refs=refs+1 WHERE fingerprint=?",
+                                   (fingerprint,)).rowcount
+            if updated == 0:
+                if assistant_id is None:
+                    return None
+                conn.execute("INSERT INTO assistant_pool VALUES (?, ?, 1)",
+                             (fingerprint, assistant_id))
+            return conn.execute("SELECT assistant_id FROM assistant_pool WHERE fingerprint=?",
+                                (fingerprint,)).fetchone()[0]
+    except:
+        logging.error(f"Failed to acquire the assistant for {fingerprint}")
+        return None
+
+
+def release_assistant(assistant_id: str, username: str | None = None) -> int:
+    """Drop a reference to the pooled assistant and return the references left.
+
+    When username is given the user's assistant entry is removed in the same
+    commit. Returns -1 if the assistant is not pooled.
+    """
+    try:
+        with transaction():
+            if username is not None:
+                __invalidate(username)
+                conn.execute("DELETE FROM assistants WHERE username=? AND assistant_id=?",
+                             (username, assistant_id))
+            result = conn.execute("SELECT refs FROM assistant_pool WHERE assistant_id=?",
+                                  (assistant_id,)).fetchone()
+            if result is None:
+                return -1
+            refs = result[0] - 1
+            if refs > 0:
+                conn.execute("UPDATE assistant_pool SET refs=? WHERE assistant_id=?",
+                             (refs, assistant_id))
+            else:
+                conn.execute("DELETE FROM assistant_pool WHERE assistant_id=?",
+                             (assistant_id,))
+            return max(refs, 0)
+    except:
+        logging.error(f"Failed to release the assistant {assistant_id}")
+        return -1
+
+
+def reserve_pooled_threads(size: int, now: float, expired_before: float) -> list[int]:
+    """Reserve the threads missing to fill the pool to size and return the reservation ids.
+
+    The pooled threads and the reservations of every worker count, the ones
+    made before expired_before were abandoned and are dropped.
+    """
+    try:
+        with transaction():
+            # A write first, so that the counts are not changed by another worker until the commit
+            conn.execute("DELETE FROM thread_pool_reservations WHERE reserved_at<?",
+                         (expired_before,))
+            (count,) = conn.execute(
+                "SELECT (SELECT COUNT(*) FROM thread_pool) + (SELECT COUNT(*) FROM thread_pool_reservations)").fetchone()
+            return [conn.execute("INSERT INTO thread_pool_reservations (reserved_at) VALUES (?)",
+                                 (now,)).lastrowid
+                    for _ in range(size - count)]
+    except:
+        logging.error("Failed to reserve pooled threads")
         return []
-    finally:
-        cursor.close()
+
+
+def cancel_pooled_thread(reservation: int):
+    try:
+        with transaction():
+            conn.execute("DELETE FROM thread_pool_reservations WHERE id=?",
+                         (reservation,))
+    except:
+        logging.error(f"Failed to cancel the pooled thread reservation {reservation}")
+
+
+def add_pooled_thread(thread_id: str, created_at: float, reservation: int | None = None) -> bool:
+    try:
+        with transaction():
+            conn.execute("INSERT OR REPLACE INTO thread_pool VALUES (?, ?)",
+                         (thread_id, created_at))
+            if reservation is not None:
+                conn.execute("DELETE FROM thread_pool_reservations WHERE id=?",
+                             (reservation,))
+        return True
+    except:
+        logging.error(f"Failed to add the thread {thread_id} to the pool")
+        return False
+
+
+def claim_pooled_thread(created_after: float) -> str | None:
+    """Remove the oldest pooled thread created after created_after and return its id."""
+    try:
+        with transaction():
+            result = conn.execute("SELECT thread_id FROM thread_pool WHERE created_at>? ORDER BY created_at LIMIT 1",
+                                  (created_after,)).fetchone()
+            if result is None:
+                return None
+            conn.execute("DELETE FROM thread_pool WHERE thread_id=?",
+                         (result[0],))
+            return result[0]
+    except:
+        logging.error("Failed to claim a pooled thread")
+        return None
+
+
+def expire_pooled_threads(created_before: float) -> list[str]:
+    """Remove the pooled threads created before created_before and return their ids."""
+    try:
+        with transaction():
+            ids = [row[0] for row in conn.execute("SELECT thread_id FROM thread_pool WHERE created_at<=?",
+                                                  (created_before,))]
+            conn.execute("DELETE FROM thread_pool WHERE created_at<=?",
+                         (created_before,))
+            return ids
+    except:
+        logging.error("Failed to expire the pooled threads")
+        return []
+
+
+def count_pooled_threads() -> int:
+    result = __read_value("SELECT COUNT(*) FROM thread_pool", ())
+    return 0 if result is None else result[0]
+
+
+class JobItem(BaseModel):
+    id: str
+    kind: str
+    username: str | None
+    # queued, running, completed or failed
+    status: str
+    total: int
+    done: int
+    failed: int
+    result: str | None
+    error: str | None
+    created_at: float
+    updated_at: float
+
+
+JOB_COLUMNS = "id, kind, username, status, total, done, failed, result, error, created_at, updated_at"
+UNFINISHED_JOB_STATES = ("queued", "running")
+
+
+def __job_item(row: tuple) -> JobItem:
+    return JobItem(**dict(zip(JOB_COLUMNS.split(", "), row)))
+
+
+def create_job(kind: str, username: str | None = None, payload: str | None = None, items: list[str] = []) -> JobItem | None:
+    """Queue a job. items are the usernames a bulk job works through."""
+    now = time.time()
+    job = JobItem(id=str(uuid.uuid4()), kind=kind, username=username, status="queued",
+                  total=len(items), done=0, failed=0, result=None, error=None,
+                  created_at=now, updated_at=now)
+    try:
+        with transaction():
+            conn.execute(f"INSERT INTO jobs ({JOB_COLUMNS}, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (*job.model_dump().values(), payload))
+            conn.executemany("INSERT INTO job_items VALUES (?, ?, 'pending')",
+                             [(job.id, item) for item in items])
+        return job
+    except:
+        logging.error(f"Failed to create the {kind} job")
+        return None
+
+
+def get_job(job_id: str) -> JobItem | None:
+    result = __read_value(
+        f"SELECT {JOB_COLUMNS} FROM jobs WHERE id=?", (job_id,))
+    return None if result is None else __job_item(result)
+
+
+def get_job_payload(job_id: str) -> str | None:
+    result = __read_value("SELECT payload FROM jobs WHERE id=?", (job_id,))
+    return None if result is None else result[0]
+
+
+def find_unfinished_job(kind: str, username: str | None = None) -> JobItem | None:
+    result = __read_value(f"SELECT {JOB_COLUMNS} FROM jobs WHERE kind=? AND username IS ? AND status IN (?, ?) ORDER BY created_at LIMIT 1",
+                          (kind, username, *UNFINISHED_JOB_STATES))
+    return None if result is None else __job_item(result)
+
+
+def get_claimable_jobs(kind: str, expired_before: float) -> list[str]:
+    """The ids of the queued jobs and of the running ones whose lease expired."""
+    rows = __read_values("SELECT id FROM jobs WHERE kind=? AND (status='queued' OR (status='running' AND COALESCE(heartbeat, 0)<?)) ORDER BY created_at",
+                         (kind, expired_before))
+    return [row[0] for row in rows]
+
+
+def claim_job(job_id: str, owner: str, now: float, expired_before: float) -> bool:
+    """Mark the job as running for owner, unless another worker holds a live lease on it."""
+    try:
+        with transaction():
+            return conn.execute("UPDATE jobs SET status='running', owner=?, heartbeat=?, updated_at=? WHERE id=? AND (status='queued' OR (status='running' AND COALESCE(heartbeat, 0)<?))",
+                                (owner, now, now, job_id, expired_before)).rowcount == 1
+    except:
+        logging.error(f"Failed to claim job {job_id}")
+        return False
+
+
+def renew_jobs(owner: str, now: float) -> int:
+    try:
+        with transaction():
+            return conn.execute("UPDATE jobs SET heartbeat=? WHERE owner=? AND status='running'",
+                                (now, owner)).rowcount
+    except:
+        logging.error(f"Failed to renew the jobs of {owner}")
+        return 0
+
+
+def release_jobs(owner: str) -> int:
+    # Expire the leases so that another worker resumes the jobs right away
+    try:
+        with transaction():
+            return conn.execute("UPDATE jobs SET heartbeat=0 WHERE owner=? AND status='running'",
+                                (owner,)).rowcount
+    except:
+        logging.error(f"Failed to release the jobs of {owner}")
+        return 0
+
+
+def set_job_status(job_id: str, status: str, result: str | None = None, error: str | None = None):
+    try:
+        with transaction():
+            conn.execute("UPDATE jobs SET status=?, result=?, error=?, updated_at=? WHERE id=?",
+                         (status, result, error, time.time(), job_id))
+    except:
+        logging.error(f"Failed to set the status of job {job_id}")
+
+
+def get_pending_job_items(job_id: str) -> list[str]:
+    rows = __read_values("SELECT username FROM job_items WHERE job_id=? AND status='pending'",
+                         (job_id,))
+    return [row[0] for row in rows]
+
+
+def finish_job_item(job_id: str, username: str, ok: bool):
+    status = "done" if ok else "failed"
+    try:
+        with transaction():
+            updated = conn.execute("UPDATE job_items SET status=? WHERE job_id=? AND username=? AND status='pending'",
+                                   (status, job_id, username)).rowcount
+            if updated > 0:
+                conn.execute(f"UPDATE jobs SET {status}={status}+1, updated_at=? WHERE id=?",
+                             (time.time(), job_id))
+    except:
+        logging.error(f"Failed to record {username} for job {job_id}")
+
+
+def lock_thread(thread_id: str, owner: str, now: float, expired_before: float) -> bool:
+    """Take or renew the lock on the thread for owner, unless another worker holds a live one."""
+    try:
+        with transaction():
+            return conn.execute("INSERT INTO thread_locks VALUES (?, ?, ?) ON CONFLICT (thread_id) DO UPDATE SET owner=excluded.owner, heartbeat=excluded.heartbeat WHERE thread_locks.owner=excluded.owner OR thread_locks.heartbeat<?",
+                                (thread_id, owner, now, expired_before)).rowcount == 1
+    except:
+        # Only the prompts of this worker are serialized then, rather than none
+        logging.error(f"Failed to lock thread {thread_id}")
+        return True
+
+
+def unlock_thread(thread_id: str, owner: str):
+    try:
+        with transaction():
+            conn.execute("DELETE FROM thread_locks WHERE thread_id=? AND owner=?",
+                         (thread_id, owner))
+    except:
+        logging.error(f"Failed to unlock thread {thread_id}")
+
+
+class OutboxItem(BaseModel):
+    id: int
+    email_url: str
+    recipient: str
+    content: str
+    attempts: int
+
+
+def enqueue_email(email_url: str, recipient: str, content: str) -> int | None:
+    now = time.time()
+    try:
+        with transaction():
+            return conn.execute("INSERT INTO outbox (email_url, recipient, content, status, attempts, next_attempt_at, created_at) VALUES (?, ?, ?, 'pending', 0, ?, ?)",
+                                (email_url, recipient, content, now, now)).lastrowid
+    except:
+        logging.error(f"Failed to queue the email to {recipient}")
+        return None
+
+
+def claim_emails(owner: str, now: float, expired_before: float, limit: int) -> list[OutboxItem]:
+    """Mark up to limit emails as being sent by owner and return them.
+
+    The emails claimed are the ones due and the ones whose claim was made
+    before expired_before by a worker that did not finish sending them.
+    """
+    try:
+        with transaction():
+            rows = conn.execute("SELECT id, email_url, recipient, content, attempts FROM outbox WHERE (status='pending' AND next_attempt_at<=?) OR (status='sending' AND COALESCE(claimed_at, 0)<?) ORDER BY next_attempt_at LIMIT ?",
+                                (now, expired_before, limit)).fetchall()
+            conn.executemany("UPDATE outbox SET status='sending', owner=?, claimed_at=? WHERE id=?",
+                             [(owner, now, row[0]) for row in rows])
+        return [OutboxItem(id=id, email_url=email_url, recipient=recipient, content=content, attempts=attempts)
+                for (id, email_url, recipient, content, attempts) in rows]
+    except:
+        logging.error("Failed to claim the emails to send")
+        return []
+
+
+def next_email_due(lease: float) -> float | None:
+    # The claims being sent expire lease seconds after they were made
+    result = __read_value(
+        "SELECT MIN(CASE status WHEN 'pending' THEN next_attempt_at ELSE COALESCE(claimed_at, 0)+? END) FROM outbox WHERE status IN ('pending', 'sending')", (lease,))
+    return None if result is None else result[0]
+
+
+def set_email_status(id: int, status: str, attempts: int, next_attempt_at: float | None = None, error: str | None = None):
+    """Record a delivery attempt, status is sent, failed or pending to retry at next_attempt_at."""
+    now = time.time()
+    try:
+        with transaction():
+            conn.execute("UPDATE outbox SET status=?, attempts=?, next_attempt_at=COALESCE(?, next_attempt_at), last_error=?, sent_at=? WHERE id=?",
+                         (status, attempts, next_attempt_at, error, now if status == "sent" else None, id))
+    except:
+        logging.error(f"Failed to set the status of email {id}")
+
+
+def release_emails(owner: str) -> int:
+    # Emails that owner was sending when it stopped are sent again by any worker
+    try:
+        with transaction():
+            return conn.execute("UPDATE outbox SET status='pending', owner=NULL, claimed_at=NULL WHERE status='sending' AND owner=?",
+                                (owner,)).rowcount
+    except:
+        logging.error(f"Failed to release the emails of {owner}")
+        return 0
+
+
+def purge_emails(finished_before: float) -> int:
+    """Delete the emails sent or failed that were queued before finished_before."""
+    try:
+        with transaction():
+            return conn.execute("DELETE FROM outbox WHERE status IN ('sent', 'failed') AND created_at<?",
+                                (finished_before,)).rowcount
+    except:
+        logging.error("Failed to purge the outbox")
+        return 0
+
+
+def outbox_stats() -> dict:
+    rows = __read_values(
+        "SELECT status, COUNT(*) FROM outbox GROUP BY status", ())
+    return {status: count for (status, count) in rows}
+
+
+class ImageItem(BaseModel):
+    file_id: str
+    user_id: str
+    size: int
+    stored: bool
+    accessed_at: float
+
+
+IMAGE_COLUMNS = "file_id, user_id, size, stored, accessed_at"
+
+
+def __image_item(row: tuple) -> ImageItem:
+    return ImageItem(**dict(zip(IMAGE_COLUMNS.split(", "), row)))
+
+
+def record_image(file_id: str, user_id: str, size: int, accessed_at: float) -> bool:
+    try:
+        with transaction():
+            conn.execute(f"INSERT OR REPLACE INTO images ({IMAGE_COLUMNS}) VALUES (?, ?, ?, 1, ?)",
+                         (file_id, user_id, size, accessed_at))
+        return True
+    except:
+        logging.error(f"Failed to record the image {file_id}")
+        return False
+
+
+def get_image(file_id: str) -> ImageItem | None:
+    result = __read_value(
+        f"SELECT {IMAGE_COLUMNS} FROM images WHERE file_id=?", (file_id,))
+    return None if result is None else __image_item(result)
+
+
+def get_stored_images() -> list[ImageItem]:
+    rows = __read_values(
+        f"SELECT {IMAGE_COLUMNS} FROM images WHERE stored=1", ())
+    return [__image_item(row) for row in rows]
+
+
+def touch_image(file_id: str, accessed_at: float):
+    try:
+        with transaction():
+            conn.execute("UPDATE images SET accessed_at=? WHERE file_id=?",
+                         (accessed_at, file_id))
+    except:
+        logging.error(f"Failed to record the access to image {file_id}")
+
+
+def image_usage() -> int:
+    result = __read_value(
+        "SELECT COALESCE(SUM(size), 0) FROM images WHERE stored=1", ())
+    return 0 if result is None else result[0]
+
+
+def least_recent_images(limit: int) -> list[ImageItem]:
+    rows = __read_values(f"SELECT {IMAGE_COLUMNS} FROM images WHERE stored=1 ORDER BY accessed_at LIMIT ?",
+                         (limit,))
+    return [__image_item(row) for row in rows]
+
+
+def evict_images(file_ids: list[str]):
+    # The rows are kept so that the images can be downloaded again
+    try:
+        with transaction():
+            conn.executemany("UPDATE images SET stored=0, size=0 WHERE file_id=?",
+                             [(file_id,) for file_id in file_ids])
+    except:
+        logging.error(f"Failed to evict the images {file_ids}")
+
+
+def delete_images(user_id: str) -> int:
+    try:
+        with transaction():
+            return conn.execute("DELETE FROM images WHERE user_id=?", (user_id,)).rowcount
+    except:
+        logging.error(f"Failed to delete the images of user {user_id}")
+        return 0
+
+
+def get_all_user() -> list[KVStoreItem]:
+    rows = __read_values("SELECT username, name FROM users", ())
+    return [KVStoreItem(username=username, key="name", value=name or "") for (username, name) in rows]
 
 
 def get_user(username: str) -> list[KVStoreItem]:
-    return __read_values(username, None)
+    items = []
+    user = __read_value(
+        "SELECT id, name, instructions, tools FROM users WHERE username=?", (username,))
+    if user is None:
+        # Read the assistant and thread again rather than trust the cache
+        __invalidate(username)
+    else:
+        for (key, value) in zip(("id", "name", "instructions", "tools"), user):
+            if value is not None:
+                items.append(KVStoreItem(
+                    username=username, key=key, value=value))
+    for item in (get_assistant(username), get_thread(username)):
+        if item is not None:
+            items.append(item)
+    items.extend(get_files(username))
+    return items
 
 
 def del_user(username: str) -> int:
     return __delete_value(username)
 
 
+def cache_stats() -> dict:
+    return cache.stats()
+
+
 def tests():
     create_assistant("alex", "assistant_id")
     create_thread("alex", "thread_id")
@@ -1,10 +1,22 @@
+from contextlib import asynccontextmanager
 from fastapi.staticfiles import StaticFiles
 import kvstore
-from openai import AzureOpenAI
-from models import AssistantCreateRequest, AssistantCreateResponse, ResponseMessage, PromptRequest
+import clients
+import countries
+from cache import MISSING, TTLCache
+from models import AssistantCreateRequest, ResponseMessage, PromptRequest
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
+import images
+import jobs
+import metrics
+import outbox
 import playground
+import quotes
+import runpoller
+import runqueue
+import warmpool
 import logging
 import settings
 # Read the environment variables into settings
@@ -14,17 +26,40 @@ settings = settings.Instance()
 logging.basicConfig(format='%(asctime)s %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
 
-# Create the SQLite KV store
-kvstore.create_store()
-
-
-# Create an Azure OpenAI client
-client = AzureOpenAI(api_key=settings.api_key,
-                     api_version=settings.api_version,
-                     azure_endpoint=settings.api_endpoint)
+# Assistants and threads that were retrieved recently, keyed by id
+validated_objects = TTLCache(
+    settings.validated_cache_size, settings.validated_cache_ttl)
+
+
+# Open the store and build the clients when the app starts, not on import
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create the SQLite KV store
+    kvstore.create_store()
+    # Create the Azure OpenAI clients
+    clients.Async()
+    clients.Http()
+    # Keep empty threads ready for new users
+    warmpool.Instance().start(clients.Async())
+    # Resume the background jobs that were interrupted
+    jobs.Instance().start()
+    # Deliver the queued emails
+    outbox.Instance().start()
+    # Index the saved images and keep them within their quota
+    images.Instance().start()
+    # Keep the country snapshot of get_country_data up to date
+    countries.Instance().start(clients.Http())
+    yield
+    await countries.Instance().stop()
+    await images.Instance().stop()
+    await outbox.Instance().stop()
+    await jobs.Instance().stop()
+    await warmpool.Instance().stop()
+    # Close the pooled connections on shutdown
+    await clients.close()
 
 # Create a FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS
 app.add_middleware(
@@ -33,8 +68,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+# Time the requests and their stages for /metrics and the Server-Timing header
+app.add_middleware(metrics.MetricsMiddleware,
+                   server_timing=settings.metrics_server_timing)
+
 
 # Get the Assistant status for a user
 @app.get("/api/status/{userName}", response_model=list[kvstore.KVStoreItem])
@@ -46,8 +86,8 @@ def get_status(userName: str):
     return items
 
 
-# Create an Assistant for a user
-@app.post("/api/create", response_model=AssistantCreateResponse)
+# Queue the creation of an Assistant for a user
+@app.post("/api/create", status_code=202, response_model=kvstore.JobItem)
 async def create_assistant(request: AssistantCreateRequest):
 
     if request.userName is None or request.userName == "":
@@ -63,22 +103,84 @@ async def create_assistant(request: AssistantCreateRequest):
         raise HTTPException(
             status_code=400, detail=".fileURLs missing. No files were provided")
 
-    # Create the files
-    file_ids = await playground.create_files(
-        client, request.userName, request.fileURLs)
+    # The files, Assistant and thread are created by a background worker
+    job = jobs.Instance().create_assistant(request)
+    if job is None:
+        raise HTTPException(
+            status_code=500, detail="Unable to queue the assistant creation")
+    return job
+
+
+# Retrieve an object unless it was validated recently
+async def get_validated(id: str, retrieve):
+    item = validated_objects.get(id)
+    if item is MISSING:
+        item = await retrieve(id)
+        validated_objects.set(id, item)
+    return item
+
 
-    # Create the Assistant and the thread for the user
-    (assistant_id, thread_id, tools) = playground.create_assistant(client,
-                                                                   request.userName, request.name, request.instructions, file_ids, settings.api_deployment_name)
+# Find the user's Assistant and thread
+async def get_assistant_and_thread(client, userName: str):
+    with metrics.timed("retrieve"):
+        return await __get_assistant_and_thread(client, userName)
 
-    if assistant_id is None or thread_id is None:
+
+async def __get_assistant_and_thread(client, userName: str):
+    from openai import NotFoundError, RateLimitError
+    # Find the assistant for the user
+    user_assistant = kvstore.get_assistant(userName)
+    assistant = None
+    if user_assistant is None:
         raise HTTPException(
-            status_code=500, detail="Unable to create the assistant")
+            status_code=404, detail=f"Assistant not found for user {userName}")
+    try:
+        assistant = await get_validated(user_assistant.value, client.beta.assistants.retrieve)
+    except RateLimitError:
+        raise_throttled()
+    except NotFoundError:
+        raise HTTPException(
+            status_code=404, detail=f"Assistant not found for user {userName}")
 
-    return AssistantCreateResponse(userName=request.userName, name=request.name,
-                                   instructions=request.instructions, tools=tools,
-                                   assistant_id=assistant_id,
-                                   thread_id=thread_id, file_ids=file_ids)
+    # Find the thread for the user
+    user_thread = kvstore.get_thread(userName)
+    thread = None
+    if user_thread is None:
+        raise HTTPException(
+            status_code=404, detail=f"thread not found for user {userName}")
+    try:
+        thread = await get_validated(user_thread.value, client.beta.threads.retrieve)
+    except RateLimitError:
+        raise_throttled()
+    except NotFoundError:
+        raise HTTPException(
+            status_code=404, detail=f"thread not found for user {userName}")
+    return (assistant, thread)
+
+
+# Revalidate the Assistant and thread after the API reported one of them missing
+async def raise_not_found(client, userName: str, assistant, thread):
+    validated_objects.pop(assistant.id)
+    validated_objects.pop(thread.id)
+    # The user may have been recreated by another worker
+    kvstore.evict_user(userName)
+    await get_assistant_and_thread(client, userName)
+    raise HTTPException(
+        status_code=404, detail=f"Assistant or thread not found for user {userName}")
+
+
+# Azure OpenAI kept throttling after the retries
+def raise_throttled():
+    raise HTTPException(
+        status_code=429, detail="The Azure OpenAI deployment is busy, try again later",
+        headers={"Retry-After": "5"})
+
+
+# Reject a prompt when too many are already waiting for the user's thread
+def raise_busy(userName: str):
+    raise HTTPException(
+        status_code=429, detail=f"Too many prompts waiting for user {userName}, try again later",
+        headers={"Retry-After": "1"})
 
 
 # Process a Prompt using the user's Assistant
@@ -92,44 +194,83 @@ async def post_process(request: PromptRequest):
         raise HTTPException(
             status_code=400, detail="No prompt was provided. Prompt is required.")
 
-    # Find the assistant for the user
-    user_assistant = kvstore.get_assistant(request.userName)
-    assistant = None
-    if user_assistant is None:
-        raise HTTPException(
-            status_code=404, detail=f"Assistant not found for user {request.userName}")
+    from openai import NotFoundError, RateLimitError
+    client = clients.Async()
+    (assistant, thread) = await get_assistant_and_thread(client, request.userName)
+
     try:
-        assistant = client.beta.assistants.retrieve(user_assistant.value)
-    except:
+        # Wait for the runs already using the thread, prompts close together share a run
+        return await runqueue.Instance().submit(thread.id, request.prompt,
+                                                lambda prompts: playground.process_prompt(client, assistant, thread, prompts, settings.email_URI, request.userName))
+    except runqueue.QueueFullError:
+        raise_busy(request.userName)
+    except RateLimitError:
+        raise_throttled()
+    except NotFoundError:
+        await raise_not_found(client, request.userName, assistant, thread)
+
+
+# Process a Prompt and stream the Assistant output as server-sent events
+@app.post("/api/process/stream")
+async def post_process_stream(request: PromptRequest):
+    if request.userName is None or request.userName == "":
         raise HTTPException(
-            status_code=404, detail=f"Assistant not found for user {request.userName}")
+            status_code=400, detail="No user name name was provided. User name is required.")
 
-    # Find the thread for the user
-    user_thread = kvstore.get_thread(request.userName)
-    thread = None
-    if user_thread is None:
-        raise HTTPException(
-            status_code=404, detail=f"thread not found for user {request.userName}")
-    try:
-        thread = client.beta.threads.retrieve(user_thread.value)
-    except:
+    if request.prompt is None or request.prompt == "":
         raise HTTPException(
-            status_code=404, detail=f"thread not found for user {request.userName}")
+            status_code=400, detail="No prompt was provided. Prompt is required.")
+
+    from openai import NotFoundError, RateLimitError
+    client = clients.Async()
+    (assistant, thread) = await get_assistant_and_thread(client, request.userName)
 
-    return await playground.process_prompt(client, assistant, thread, request.prompt, settings.email_URI, request.userName)
+    async def serialized():
+        # Keep the thread until the stream is finished
+        async with runqueue.Instance().exclusive(thread.id):
+            async for event in playground.stream_prompt(
+                    client, assistant, thread, request.prompt, settings.email_URI, request.userName):
+                yield event
+
+    stream = serialized()
+    try:
+        # Start the run before the response so a missing thread is still a 404
+        first = await anext(stream)
+    except runqueue.QueueFullError:
+        raise_busy(request.userName)
+    except RateLimitError:
+        raise_throttled()
+    except NotFoundError:
+        await raise_not_found(client, request.userName, assistant, thread)
+
+    async def events():
+        (event, message) = first
+        yield f"event: {event}\ndata: {message.model_dump_json()}\n\n"
+        try:
+            async for (event, message) in stream:
+                yield f"event: {event}\ndata: {message.model_dump_json()}\n\n"
+        except NotFoundError:
+            validated_objects.pop(assistant.id)
+            validated_objects.pop(thread.id)
+            message = ResponseMessage(
+                role="system", content=f"Assistant or thread not found for user {request.userName}")
+            yield f"event: error\ndata: {message.model_dump_json()}\n\n"
+        except RateLimitError:
+            message = ResponseMessage(
+                role="system", content="The Azure OpenAI deployment is busy, try again later")
+            yield f"event: error\ndata: {message.model_dump_json()}\n\n"
+        finally:
+            await stream.aclose()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 # Delete an Assistant
 @app.delete("/api/delete/{userName}")
-def delete(userName: str):
-    error = playground.delete_assistant(client, userName)
-    if error is not None:
-        raise HTTPException(
-            status_code=404, detail=f"User {userName} note found")
-
-    # Delete the KVStore entries for the user
-    count = kvstore.del_user(userName)
-    if count > 0:
+async def delete(userName: str):
+    deleted = await jobs.delete_user(clients.Async(), userName)
+    if deleted:
         return {"message": f"Assistant deleted for user: {userName}"}
     else:
         raise HTTPException(
@@ -137,26 +278,24 @@ def delete(userName: str):
 
 
 # Maintenance routes
-# Delete all Assistants
-@app.delete("/api/delete")
-def delete_all():
-
-    kv_all_users = kvstore.get_all_user()
-    # Delete all the Assistants for all users
-    for user in kv_all_users:
-        userName = user.value
-        error = playground.delete_assistant(client, userName)
-        if error is not None:
-            raise HTTPException(
-                status_code=404, detail=f"User {userName} note found")
-
-        # Delete the KVStore entries for the user
-        count = kvstore.del_user(userName)
-        if count > 0:
-            return {"message": f"Assistant deleted for user: {userName}"}
-        else:
-            raise HTTPException(
-                status_code=404, detail=f"User {userName} not found")
+# Delete all Assistants in a background job
+@app.delete("/api/delete", status_code=202, response_model=kvstore.JobItem)
+async def delete_all():
+    job = jobs.Instance().delete_all()
+    if job is None:
+        raise HTTPException(
+            status_code=500, detail="Unable to start the delete job")
+    return job
+
+
+# Get the progress of a background job
+@app.get("/api/jobs/{jobId}", response_model=kvstore.JobItem)
+def get_job(jobId: str):
+    job = kvstore.get_job(jobId)
+    if job is None:
+        raise HTTPException(
+            status_code=404, detail=f"job {jobId} not found")
+    return job
 
 
 # Get all status for all users
@@ -169,6 +308,45 @@ def get_all_status():
     return items
 
 
+# Get the pool, cache and polling metrics
+@app.get("/api/stats")
+def get_stats():
+    return {"thread_pool": warmpool.Instance().stats(),
+            "kvstore_cache": kvstore.cache_stats(),
+            "validated_cache": validated_objects.stats(),
+            "quote_cache": quotes.stats(),
+            "active_runs": runpoller.Instance().active_runs(),
+            "queued_prompts": runqueue.Instance().pending(),
+            "openai": clients.stats(),
+            "outbox": outbox.Instance().stats(),
+            "images": images.Instance().stats()}
+
+
+# Serve a response image, downloading it again if it was evicted
+@app.get("/images/{userId}/{fileName}")
+async def get_image(userId: str, fileName: str, request: Request):
+    file_id = fileName.removesuffix(".png")
+    store = images.Instance()
+    if store.find(userId, file_id) is None:
+        raise HTTPException(
+            status_code=404, detail=f"image {fileName} not found")
+    headers = {"ETag": images.etag(file_id),
+               "Cache-Control": images.CACHE_CONTROL}
+    if images.matches(request.headers.get("if-none-match"), file_id):
+        store.touch(file_id)
+        return Response(status_code=304, headers=headers)
+    if not await store.save(clients.Async(), userId, file_id):
+        raise HTTPException(
+            status_code=404, detail=f"image {fileName} not found")
+    return FileResponse(store.path(userId, file_id), media_type="image/png", headers=headers)
+
+
+# Get the latency histograms and counters in the Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 # Show the static files
 if settings.deploy_spa == "True":
     app.mount("/", StaticFiles(directory="wwwroot", html=True), name="site")
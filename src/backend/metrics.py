@@ -0,0 +1,182 @@
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, and buckets for counts such as the polls of a run
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+
+PREFIX = "commander_"
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count for each set of label values."""
+
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple = SECONDS_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum, count]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        with lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with lock:
+            series = [(label_values, list(counts), total, count)
+                      for (label_values, (counts, total, count)) in self._series.items()]
+        for (label_values, counts, total, count) in series:
+            labels = format_labels(self.labels, label_values)
+            cumulative = 0
+            for (bound, bucket) in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                lines.append(
+                    f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = labels
+        self._series: dict[tuple, float] = {}
+
+    def inc(self, *label_values, value: float = 1):
+        with lock:
+            self._series[label_values] = self._series.get(
+                label_values, 0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with lock:
+            series = list(self._series.items())
+        for (label_values, value) in series:
+            lines.append(
+                f"{self.name}{{{format_labels(self.labels, label_values)}}} {value}")
+        return lines
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    return ",".join(f'{name}="{escape_label(value)}"' for (name, value) in zip(names, values))
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+lock = threading.Lock()
+
+http_requests = Histogram("http_request_duration_seconds",
+                          "Time to answer the API requests", ("method", "route", "status"))
+stages = Histogram("stage_duration_seconds",
+                   "Time spent in each stage of the request pipeline", ("stage",))
+azure_requests = Histogram("azure_request_duration_seconds",
+                           "Time of each Azure OpenAI call, retries included", ("operation", "status"))
+azure_retries = Counter("azure_retries_total",
+                        "Azure OpenAI calls sent again after throttling or errors", ("operation",))
+run_polls = Histogram("run_polls", "Status polls of each run until it needed attention",
+                      ("status",), COUNT_BUCKETS)
+tool_calls = Histogram("tool_duration_seconds",
+                       "Time to run each tool call", ("tool", "outcome"))
+
+# Stage name -> [total seconds, count] for the request being served
+request_timings: contextvars.ContextVar[dict | None] = contextvars.ContextVar(
+    "request_timings", default=None)
+
+
+def record(stage: str, seconds: float):
+    """Add the time of a stage to the histogram and to the Server-Timing of the request."""
+    stages.observe(seconds, stage)
+    add_timing(stage, seconds)
+
+
+def add_timing(stage: str, seconds: float, timings: dict | None = None):
+    """Add the time to the Server-Timing of the request only.
+
+    The request is the current one, or the one timings were taken from.
+    """
+    if timings is None:
+        timings = request_timings.get()
+    if timings is not None:
+        timing = timings.get(stage)
+        if timing is None:
+            timings[stage] = [seconds, 1]
+        else:
+            timing[0] += seconds
+            timing[1] += 1
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def render() -> str:
+    lines = []
+    for metric in (http_requests, stages, azure_requests, azure_retries, run_polls, tool_calls):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Times every request and adds its stages as a Server-Timing header.
+
+    A plain ASGI middleware, so streamed responses pass through untouched.
+    """
+
+    def __init__(self, app, server_timing: bool = True):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        timings = {}
+        token = request_timings.set(timings)
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    total = (time.perf_counter() - start) * 1000
+                    entries = [f"{stage};dur={seconds * 1000:.1f};desc=\"{count}x\""
+                               for (stage, (seconds, count)) in timings.items()]
+                    entries.append(f"total;dur={total:.1f}")
+                    message["headers"] = [*message.get("headers", []),
+                                          (b"server-timing", ", ".join(entries).encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            request_timings.reset(token)
+            # The route template keeps the label values bounded
+            route = scope.get("route")
+            path = (route.path or "/") if route is not None else "unmatched"
+            http_requests.observe(time.perf_counter() - start,
+                                  scope["method"], path, status)
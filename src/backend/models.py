@@ -37,6 +37,7 @@ class AssistantCreateResponse(BaseModel):
     assistant_id: str
     thread_id: str
     file_ids: list[str]
+    failed_file_urls: list[str] = []
 
 
 class ResponseMessage(BaseModel):
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+import clients
+import kvstore
+import settings
+
+
+class EmailOutbox:
+    """Delivers the emails queued in the kvstore outbox to Logic Apps.
+
+    A background task claims the due emails in batches and posts them
+    concurrently on the shared HTTP client. Failed deliveries are retried
+    with exponential backoff until max_attempts, client errors other than
+    timeouts and throttling fail right away.
+
+    Each worker process claims the emails under its own owner id. Emails
+    claimed by a worker that stopped without sending them are claimed again
+    once lease seconds passed. Sent and failed emails are deleted retention
+    seconds after they were queued.
+    """
+
+    def __init__(self, batch_size: int, max_attempts: int, retry_delay: float, poll_interval: float,
+                 lease: float, retention: float):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retention = retention
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._purged = 0.0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.__send())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        kvstore.release_emails(self.owner)
+
+    def wake(self):
+        """Send the queued emails now instead of at the next poll."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {"queue": kvstore.outbox_stats(), "sent": self.sent,
+                "retried": self.retried, "failed": self.failed}
+
+    async def __send(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                now = time.time()
+                emails = kvstore.claim_emails(self.owner, now, now - self.lease,
+                                              self.batch_size)
+                if emails:
+                    await asyncio.gather(*[self.__deliver(email) for email in emails])
+                    # There may be more emails due
+                    continue
+                if now - self._purged >= self.poll_interval:
+                    self._purged = now
+                    kvstore.purge_emails(now - self.retention)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Unable to send the queued emails: {e}")
+
+            # Wait for a new email, the next retry or the poll period
+            timeout = self.poll_interval
+            due = kvstore.next_email_due(self.lease)
+            if due is not None:
+                timeout = max(0.0, min(timeout, due - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __deliver(self, email: kvstore.OutboxItem):
+        attempts = email.attempts + 1
+        try:
+            response = await clients.Http().post(email.email_url,
+                                                 json={"to": email.recipient, "content": email.content})
+            if response.is_success:
+                kvstore.set_email_status(email.id, "sent", attempts)
+                self.sent += 1
+                logging.info(f"Email sent to: {email.recipient}")
+                return
+            error = f"Logic Apps returned {response.status_code}"
+            retry = response.status_code >= 500 or response.status_code in (408, 429)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            retry = True
+
+        if retry and attempts < self.max_attempts:
+            delay = self.retry_delay * (2 ** (attempts - 1))
+            kvstore.set_email_status(email.id, "pending", attempts,
+                                     time.time() + delay, error)
+            self.retried += 1
+            logging.warning(
+                f"Unable to send email {email.id} to {email.recipient} ({error}), retrying in {delay}s")
+        else:
+            kvstore.set_email_status(email.id, "failed", attempts, error=error)
+            self.failed += 1
+            logging.error(
+                f"Unable to send email {email.id} to {email.recipient}: {error}")
+
+
+outbox = None
+
+
+def Instance() -> EmailOutbox:
+    global outbox
+    if outbox is None:
+        config = settings.Instance()
+        outbox = EmailOutbox(config.outbox_batch_size, config.outbox_max_attempts,
+                             config.outbox_retry_delay, config.outbox_poll_interval,
+                             config.outbox_lease, config.outbox_retention)
+    return outbox
@@ -1,109 +1,218 @@
-import base64
-import shutil
+import hashlib
 from urllib.parse import urlparse
 import asyncio
-import httpx
+from concurrent.futures import ThreadPoolExecutor
 
+import clients
+import images
 import kvstore
+import metrics
+import runpoller
+import warmpool
+import settings
 from models import ResponseMessage
 import tools
-import requests
 import logging
-import io
 import os
 import json
+import re
 import time
 from datetime import datetime
 
-from openai.types.beta.threads.message_content_text import MessageContentText
-from openai.types.beta.threads.message_content_image_file import MessageContentImageFile
+# Azure rejects new messages and runs while a run is active on the thread
+ACTIVE_RUN = re.compile(r"active run (run_\w+)|run (run_\w+) is active")
 
 
-def __user_folders(user_name: str):
-    kvitem_user_id = kvstore.get_user_id(user_name)
-    return (f"wwwroot/images/{kvitem_user_id.value}/", f"images/{kvitem_user_id.value}/")
+async def __messages_to_responses(client, messages: list, user_name: str) -> list[ResponseMessage]:
+    response_messages = []
+    image_files = []
+    for message in messages:
+        for item in message.content:
+            if item.type == "text":
+                if item.text.value is None or item.text.value == "":
+                    continue
+                response_messages.append(
+                    ResponseMessage(role=message.role, content=item.text.value))
+            elif item.type == "image_file":
+                # Add an image to the list, the url is set once it is saved
+                response_message = ResponseMessage(
+                    role=message.role, content="")
+                response_messages.append(response_message)
+                image_files.append((response_message, item.image_file.file_id))
+    if image_files == []:
+        return response_messages
+
+    # Download the images in parallel
+    user_id = kvstore.get_user_id(user_name).value
+    semaphore = asyncio.Semaphore(settings.Instance().image_download_concurrency)
+    with metrics.timed("images"):
+        saved = await asyncio.gather(*[images.Instance().save(client, user_id, file_id, semaphore)
+                                       for (_, file_id) in image_files])
+    failed = set()
+    for ((response_message, file_id), ok) in zip(image_files, saved):
+        if ok:
+            response_message.imageContent = images.url(user_id, file_id)
+        else:
+            failed.add(id(response_message))
+    return [message for message in response_messages if id(message) not in failed]
 
 
-def get_response_messages(client, messages, user_name: str) -> list[ResponseMessage]:
+async def get_response_messages(client, messages, user_name: str) -> list[ResponseMessage]:
     message_list = []
     # From all the messages in the tread, get the messages till the last user message only.
-    for message in messages:
+    async for message in messages:
         message_list.append(message)
         if message.role == "user":
             break
     # Reverse the messages to show the last user message first
     message_list.reverse()
     # Get a list of Assistant text and images for the UI
-    response_messages = []
-    for message in message_list:
-        for item in message.content:
-            if isinstance(item, MessageContentText):
-                if item.text.value is None or item.text.value == "":
-                    continue
-                response_messages.append(
-                    ResponseMessage(role=message.role, content=item.text.value))
-            elif isinstance(item, MessageContentImageFile):
-                # Retrieve image from file by id
-                response_content = client.files.content(
-                    item.image_file.file_id)
-                # Read the bytes
-                image_data = response_content.read()
-                (user_image_folder_path, url_path) = __user_folders(user_name)
-                if not os.path.exists(user_image_folder_path):
-                    os.makedirs(user_image_folder_path)
-                # Save the file
-                full_file_path = f"{user_image_folder_path}{item.image_file.file_id}.png"
-                url_path = f"{url_path}/{item.image_file.file_id}.png"
-                logging.info(
-                    f"Saving image to {full_file_path} and available at {url_path}")
-                with open(f"{full_file_path}", "wb") as f:
-                    f.write(image_data)
-                # Encode the bytes into base64 and then utf-u
-                # imageContent = base64.b64encode(image_data).decode('utf-8')
-                if (len(message.content) > 0):
-                    # Add an image to the list
-                    response_messages.append(
-                        ResponseMessage(role=message.role, content="", imageContent=f"{url_path}"))
-                    # ResponseMessage(role=message.role, content="", imageContent="data:image/png;base64,"+imageContent))
-    # Return the list of ResponseMessages
-    return response_messages
-
-
-async def __read_file_from_url(url) -> bytes | None:
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(url, headers={"content-type": "application/octet-stream"})
-        #resp = requests.get(url, headers={
-        #                    "content-type": "application/octet-stream"})
-        #resp.raise_for_status()
-            fileBytes = resp.content
-            return fileBytes
-    except:
-        logging.error("Unable to read file from url: %s", url)
-        return None
-
-
-async def create_files(client, user_name: str, file_urls: list[str]) -> list[str]:
+    return await __messages_to_responses(client, message_list, user_name)
+
+
+async def __list_new_messages(client, thread, user_name: str, prompts: int = 1) -> list:
+    """List the thread messages since the last response, oldest first.
+
+    Only the messages after the thread cursor are fetched, so the cost does
+    not grow with the length of the conversation. prompts is the number of
+    user messages the last run answered.
+    """
+    page_size = settings.Instance().message_page_size
+    cursor = kvstore.get_thread_cursor(user_name)
+    messages = []
+    if cursor is not None:
+        while True:
+            page = await client.beta.threads.messages.list(thread_id=thread.id, order="asc",
+                                                           after=cursor, limit=page_size)
+            messages.extend(page.data)
+            # A short page is the last one
+            if len(page.data) < page_size:
+                break
+            cursor = page.data[-1].id
+    else:
+        # No cursor yet, walk back to the user messages of the last run
+        user_messages = 0
+        async for message in client.beta.threads.messages.list(thread_id=thread.id, order="desc",
+                                                               limit=page_size):
+            messages.append(message)
+            if message.role == "user":
+                user_messages += 1
+                if user_messages == prompts:
+                    break
+        messages.reverse()
+    if messages == []:
+        return messages
+    kvstore.set_thread_cursor(user_name, messages[-1].id)
+    # Start at the user messages of the last run, earlier ones belong to runs that did not finish
+    user_messages = 0
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].role == "user":
+            user_messages += 1
+            if user_messages == prompts:
+                return messages[index:]
+    return messages
+
+
+async def __with_retries(action, description: str, retries: int, retry_delay: float):
+    # Retry an async action with exponential backoff, re-raising the last error
+    import httpx
+    for attempt in range(retries + 1):
+        try:
+            return await action()
+        except Exception as e:
+            # Client errors other than timeouts and throttling will not go away
+            if isinstance(e, httpx.HTTPStatusError) and 400 <= e.response.status_code < 500 \
+                    and e.response.status_code not in (408, 429):
+                raise
+            if attempt == retries:
+                raise
+            delay = retry_delay * (2 ** attempt)
+            logging.warning(
+                f"Attempt {attempt + 1} to {description} failed ({e}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+
+async def __read_file_from_url(http_client, url, headers: dict):
+    resp = await http_client.get(url, headers={"content-type": "application/octet-stream", **headers})
+    if resp.status_code != 304:
+        resp.raise_for_status()
+    return resp
+
+
+async def __create_file(client, http_client, user_name: str, url: str, semaphore: asyncio.Semaphore,
+                        retries: int, retry_delay: float) -> (str, str):
+    parsed_url = urlparse(url)
+    file_name = os.path.basename(parsed_url.path)
+    async with semaphore:
+        # Revalidate urls we have seen before instead of downloading them again
+        headers = {}
+        file_url = kvstore.get_file_url(url)
+        if file_url is not None:
+            if file_url.etag is not None:
+                headers["If-None-Match"] = file_url.etag
+            if file_url.last_modified is not None:
+                headers["If-Modified-Since"] = file_url.last_modified
+        resp = await __with_retries(lambda: __read_file_from_url(http_client, url, headers),
+                                    f"download {url}", retries, retry_delay)
+        if resp.status_code == 304:
+            file_id = kvstore.acquire_file(file_url.sha256, user_name, file_name)
+            if file_id is not None:
+                logging.info(f"Reusing file {file_id} for unchanged url {url}")
+                return (file_name, file_id)
+            # The indexed file was deleted in the meantime, download it again
+            resp = await __with_retries(lambda: __read_file_from_url(http_client, url, {}),
+                                        f"download {url}", retries, retry_delay)
+
+        # Reuse a file that was uploaded with the same content
+        file_bytes = resp.content
+        sha256 = await asyncio.to_thread(lambda: hashlib.sha256(file_bytes).hexdigest())
+        kvstore.set_file_url(url, resp.headers.get("etag"),
+                             resp.headers.get("last-modified"), sha256)
+        file_id = kvstore.acquire_file(sha256, user_name, file_name)
+        if file_id is not None:
+            logging.info(f"Reusing file {file_id} with the content of {url}")
+            return (file_name, file_id)
+
+        # Create the Assistant File from the file contents, ThrottledTransport already retries the upload
+        assistant_file = await client.files.create(file=(file_name, file_bytes), purpose="assistants")
+    file_id = kvstore.acquire_file(
+        sha256, user_name, file_name, assistant_file.id)
+    if file_id != assistant_file.id:
+        # Another request uploaded the same content first, keep that one
+        try:
+            await client.files.delete(assistant_file.id)
+        except:
+            logging.warning(f"Unable to delete file: {assistant_file.id}")
+    return (file_name, file_id)
+
+
+async def create_files(client, user_name: str, file_urls: list[str]) -> (list[str], list[str]):
+    """Download and upload the files concurrently.
+
+    Returns the ids of the files that were created and the urls that failed.
+    """
     # sample file:
     # "https://alemoraoaist.z13.web.core.windows.net/docs/Energy/operating_ranges.csv"
     # "https://alemoraoaist.z13.web.core.windows.net/docs/Energy/wind_turbines_telemetry.csv"
-    kv_files = []
-    for url in file_urls:
-        # Read the file contents from the url
-        fileRead = await __read_file_from_url(url)
-
-        # Create the Assistant File from the file contents
-        assistant_file = client.files.create(
-            file=io.BytesIO(fileRead), purpose="assistants")
+    config = settings.Instance()
+    semaphore = asyncio.Semaphore(config.ingest_concurrency)
+    http_client = clients.Http()
+    # Each url is referenced once per user
+    file_urls = list(dict.fromkeys(file_urls))
+    results = await asyncio.gather(*[__create_file(client, http_client, user_name, url, semaphore,
+                                                   config.ingest_retries, config.ingest_retry_delay)
+                                     for url in file_urls], return_exceptions=True)
 
-        # Create the KVStore entry for the file
-        if fileRead is not None and assistant_file is not None:
-            parsed_url = urlparse(url)
-            file_name = os.path.basename(parsed_url.path)
-            kv_files.append((file_name, assistant_file.id))
+    kv_files = []
+    failed_urls = []
+    for (url, result) in zip(file_urls, results):
+        if isinstance(result, BaseException):
+            logging.error(f"Unable to create a file from url {url}: {result}")
+            failed_urls.append(url)
+        else:
+            kv_files.append(result)
 
-    # Create the KVStore entries for the files
-    kvstore.create_files(user_name, kv_files)
+    # The KVStore entries for the files were added with their references
 
     # Get the file ids
     file_ids = []
@@ -111,154 +220,248 @@ async def create_files(client, user_name: str, file_urls: list[str]) -> list[str
         (_, id) = file
         file_ids.append(id)
 
-    # Return the file ids
-    return file_ids
+    # Return the file ids and the failures
+    return (file_ids, failed_urls)
 
 
-def create_thread(client, user_name: str):
-    thread = None
-    try:
-        id = kvstore.get_thread(user_name)
-        if id is not None and id != "":
-            thread = client.beta.threads.retrieve(id)
-        if thread is None:
-            raise Exception("Thread not found")
-    except:
-        thread = client.beta.threads.create()
-    kvstore.create_thread(user_name, thread.id)
-    return thread
+async def create_thread(client, user_name: str) -> str:
+    # Take an empty thread from the pool, the previous thread is not reused
+    thread_id = await warmpool.Instance().claim(client)
+    kvstore.create_thread(user_name, thread_id)
+    return thread_id
+
+
+def __tool_error(func_name: str, error: str, message: str) -> str:
+    # Tell the Assistant what went wrong instead of failing the run
+    return json.dumps({"error": error, "function": func_name, "message": message})
+
 
+# Blocking tools run on a bounded pool off the event loop
+tool_executor = None
 
-def call_functions(client, thread, run, email_URI: str):
+
+def __ensure_tool_executor():
+    global tool_executor
+    if tool_executor is None:
+        tool_executor = ThreadPoolExecutor(max_workers=settings.Instance().tool_workers,
+                                           thread_name_prefix="tool")
+
+
+def __tool_timeout(func_name: str) -> float:
+    tool = tools.registry.get(func_name)
+    if tool is not None and tool.timeout is not None:
+        return tool.timeout
+    return settings.Instance().tool_timeout
+
+
+async def __call_function(action: dict, email_URI: str) -> dict:
+    func_name = action['function']['name']
+    timeout = __tool_timeout(func_name)
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        output = await asyncio.wait_for(
+            tools.call(func_name, action['function']['arguments'],
+                       {"email_uri": email_URI}, tool_executor),
+            timeout=timeout)
+    except asyncio.TimeoutError:
+        # The worker thread cannot be interrupted, its result is discarded
+        logging.warning(f"Function {func_name} timed out after {timeout}s")
+        output = __tool_error(func_name, "timeout",
+                              f"The function did not finish within {timeout} seconds")
+        outcome = "timeout"
+    except Exception as e:
+        logging.error(f"Function {func_name} failed: {e}")
+        output = __tool_error(func_name, type(e).__name__, str(e))
+        outcome = "error"
+    # Unknown names come from the model, keep the label values bounded
+    tool_name = func_name if func_name in tools.registry else "unknown"
+    metrics.tool_calls.observe(time.perf_counter() - start, tool_name, outcome)
+    return {
+        "tool_call_id": action['id'],
+        "output": output
+    }
+
+
+async def __prefetch(actions: list[dict]):
+    # Resolve the calls of a tool in one request when a step calls it several times
+    calls = {}
+    for action in actions:
+        tool = tools.registry.get(action['function']['name'])
+        if tool is None or tool.prefetch is None:
+            continue
+        try:
+            arguments = tool.validate(json.loads(
+                action['function']['arguments']))
+        except:
+            continue
+        calls.setdefault(tool.name, []).append(arguments)
+    loop = asyncio.get_running_loop()
+    for (func_name, arguments) in calls.items():
+        if len(arguments) < 2:
+            continue
+        try:
+            await asyncio.wait_for(loop.run_in_executor(tool_executor, tools.registry[func_name].prefetch, arguments),
+                                   timeout=__tool_timeout(func_name))
+        except Exception as e:
+            logging.warning(f"Unable to prefetch {func_name}: {e}")
+
+
+async def call_functions(client, thread, run, email_URI: str):
     print("Function Calling")
     required_actions = run.required_action.submit_tool_outputs.model_dump()
     print(required_actions)
-    tool_outputs = []
-    import json
-    for action in required_actions["tool_calls"]:
-        func_name = action['function']['name']
-        arguments = json.loads(action['function']['arguments'])
-
-        if func_name == "get_stock_price":
-            output = tools.get_stock_price(symbol=arguments['symbol'])
-            tool_outputs.append({
-                "tool_call_id": action['id'],
-                "output": output
-            })
-        elif func_name == "send_email":
-            print("Sending email...")
-            email_to = arguments['to']
-            email_content = arguments['content']
-            tools.send_logic_apps_email(email_URI, email_to, email_content)
-
-            tool_outputs.append({
-                "tool_call_id": action['id'],
-                "output": "Email sent"
-            })
-        else:
-            raise ValueError(f"Unknown function: {func_name}")
+    __ensure_tool_executor()
+    with metrics.timed("tools"):
+        await __prefetch(required_actions["tool_calls"])
+        # Run all the calls of the step at once
+        tool_outputs = await asyncio.gather(*[__call_function(action, email_URI)
+                                              for action in required_actions["tool_calls"]])
 
     print("Submitting outputs back to the Assistant...")
-    client.beta.threads.runs.submit_tool_outputs(
+    await client.beta.threads.runs.submit_tool_outputs(
         thread_id=thread.id,
         run_id=run.id,
         tool_outputs=tool_outputs
     )
 
 
-def create_assistant(client, user_name: str, name: str, instructions: str, file_ids: list[str], api_deployment_name: str):
-    assistant = None
+def __assistant_fingerprint(instructions: str, file_ids: list[str], api_deployment_name: str) -> str:
+    # Users with the same instructions, tools and files can share an Assistant
+    fingerprint = json.dumps({"instructions": instructions, "tools": tools.tools_json,
+                              "file_ids": sorted(file_ids), "model": api_deployment_name})
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+async def __delete_remote(kind: str, id: str, delete):
     try:
-        id = kvstore.get_assistant(user_name)
-        if id is not None:
-            assistant = client.beta.assistants.retrieve(id)
-            if assistant is None:
-                raise Exception("Assistant not found")
-        else:
-            raise Exception("Assistant not found")
+        await delete(id)
     except:
-        tools_list = [
-            {"type": "code_interpreter"},
-            {"type": "function",
-             "function": {
-
-                 "name": "get_stock_price",
-                 "description": "Retrieve the latest closing price of a stock using its ticker symbol.",
-                 "parameters": {
-                     "type": "object",
-                     "properties": {
-                         "symbol": {
-                             "type": "string",
-                             "description": "The ticker symbol of the stock"
-                         }
-                     },
-                     "required": ["symbol"]
-                 }
-             }
-             },
-            {"type": "function",
-                "function": {
-                    "name": "send_email",
-                    "description": "Sends an email to a recipient(s).",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "to": {
-                                "type": "string",
-                                "description": "The email(s) the email should be sent to."
-                            },
-                            "content": {
-                                "type": "string",
-                                "description": "The content of the email."
-                            }
-                        },
-                        "required": ["to", "content"]
-                    }
-                }
-             }]
-
+        logging.warning(f"Unable to delete {kind}: {id}")
+
+
+async def create_assistant(client, user_name: str, name: str, instructions: str, file_ids: list[str], api_deployment_name: str):
+    config = settings.Instance()
+    previous = kvstore.get_assistant(user_name)
+    assistant_id = None
+    if config.shared_assistants:
+        fingerprint = __assistant_fingerprint(
+            instructions, file_ids, api_deployment_name)
+        assistant_id = kvstore.acquire_assistant(fingerprint)
+        if assistant_id is not None:
+            logging.info(
+                f"Sharing assistant {assistant_id} with user {user_name}")
+
+    if assistant_id is None:
         # Create the Assistant for the user and files
-        assistant = client.beta.assistants.create(
+        assistant = await client.beta.assistants.create(
             name=name,
             instructions=instructions,
-            tools=tools_list,
+            tools=tools.tools_list,
             model=api_deployment_name,
             file_ids=file_ids
         )
-        # Update the user's state
-        str_tools = json.dumps(tools_list)
-        kvstore.create_assistant(
-            user_name, name, instructions, str_tools, assistant.id)
-
-        # Create the thread for the user
-        thread = create_thread(client, user_name)
-
-        return (assistant.id, thread.id, str_tools)
-
-
-async def process_prompt(client, assistant, thread, prompt, email_uri, user_name: str) -> list[ResponseMessage]:
-    client.beta.threads.messages.create(
-        thread_id=thread.id,
-        role="user",
-        content=prompt
-    )
-
-    run = client.beta.threads.runs.create(
-        thread_id=thread.id,
-        assistant_id=assistant.id,
-        instructions="The current date and time is: " +
-        datetime.now().strftime("%x %X") + "."
-    )
+        assistant_id = assistant.id
+        if config.shared_assistants:
+            pooled_id = kvstore.acquire_assistant(fingerprint, assistant.id)
+            if pooled_id is not None and pooled_id != assistant.id:
+                # Another request created the shared Assistant first, use that one
+                await __delete_remote("assistant", assistant.id, client.beta.assistants.delete)
+                assistant_id = pooled_id
+
+    # Drop the reference to the shared Assistant the user had before
+    if previous is not None and kvstore.release_assistant(previous.value) == 0 \
+            and previous.value != assistant_id:
+        await __delete_remote("assistant", previous.value, client.beta.assistants.delete)
+
+    # Update the user's state
+    str_tools = tools.tools_json
+    kvstore.create_assistant(
+        user_name, name, instructions, str_tools, assistant_id)
+
+    # Create the thread for the user
+    thread_id = await create_thread(client, user_name)
+
+    return (assistant_id, thread_id, str_tools)
+
+
+async def __when_thread_free(client, thread, deadline: float, action):
+    """Call action, again once a run left active on the thread has ended.
+
+    The thread is locked for this worker, so the active run was left behind
+    by a worker that stopped or a stream that was closed. Raises
+    RunTimeoutError when it is still active at the deadline.
+    """
+    from openai import BadRequestError
+    poller = runpoller.Instance()
+    while True:
+        try:
+            return await action()
+        except BadRequestError as e:
+            match = ACTIVE_RUN.search(str(e))
+            if match is None:
+                raise
+        run_id = match.group(1) or match.group(2)
+        logging.warning(
+            f"Thread {thread.id} has an active run {run_id}, waiting for it to end")
+        run = await poller.wait(client, thread.id, run_id, deadline)
+        if run.status == "requires_action":
+            # Nobody will submit its tool outputs
+            try:
+                await client.beta.threads.runs.cancel(
+                    thread_id=thread.id, run_id=run_id)
+            except:
+                logging.warning(f"Unable to cancel run: {run_id}")
+
+
+async def __create_run(client, assistant, thread, deadline: float):
+    with metrics.timed("run_create"):
+        return await __when_thread_free(client, thread, deadline, lambda: client.beta.threads.runs.create(
+            thread_id=thread.id,
+            assistant_id=assistant.id,
+            instructions="The current date and time is: " +
+            datetime.now().strftime("%x %X") + "."
+        ))
+
+
+async def process_prompt(client, assistant, thread, prompts: list[str], email_uri, user_name: str) -> list[ResponseMessage]:
+    poller = runpoller.Instance()
+    deadline = poller.deadline()
+    try:
+        # Prompts that arrived together are answered by one run
+        with metrics.timed("message_create"):
+            for prompt in prompts:
+                await __when_thread_free(client, thread, deadline, lambda: client.beta.threads.messages.create(
+                    thread_id=thread.id,
+                    role="user",
+                    content=prompt
+                ))
+        run = await __create_run(client, assistant, thread, deadline)
+    except runpoller.RunTimeoutError:
+        logging.warning(f"Thread {thread.id} stayed busy for user {user_name}")
+        return []
 
     while True:
-        run = client.beta.threads.runs.retrieve(
-            thread_id=thread.id, run_id=run.id)
+        try:
+            with metrics.timed("run_wait"):
+                run = await poller.wait(client, thread.id, run.id, deadline)
+        except runpoller.RunTimeoutError:
+            logging.warning(
+                f"Run {run.id} timed out for user {user_name}, cancelling it")
+            try:
+                await client.beta.threads.runs.cancel(
+                    thread_id=thread.id, run_id=run.id)
+            except:
+                logging.warning(f"Unable to cancel run: {run.id}")
+            return []
         if run.status == "completed":
-            messages = client.beta.threads.messages.list(thread_id=thread.id)
-            return get_response_messages(client, messages, user_name)
+            with metrics.timed("messages_list"):
+                messages = await __list_new_messages(client, thread, user_name, len(prompts))
+            return await __messages_to_responses(client, messages, user_name)
         elif run.status == "failed":
-            messages = client.beta.threads.messages.list(thread_id=thread.id)
-            return get_response_messages(client, messages, user_name)
+            with metrics.timed("messages_list"):
+                messages = await __list_new_messages(client, thread, user_name, len(prompts))
+            return await __messages_to_responses(client, messages, user_name)
         elif run.status == "expired":
             # Handle expired
             return []
@@ -266,44 +469,145 @@ async def process_prompt(client, assistant, thread, prompt, email_uri, user_name
             # Handle cancelled
             return []
         elif run.status == "requires_action":
-            call_functions(client, thread, run, email_uri)
-        else:
-            asyncio.sleep(5)
+            await call_functions(client, thread, run, email_uri)
+
+
+async def __stream_run_steps(client, thread, run, seen: set[str], cursor: list[str], user_name: str):
+    # Emit tool call progress and finished messages from the run steps
+    steps = client.beta.threads.runs.steps.list(
+        run.id, thread_id=thread.id, order="asc")
+    async for step in steps:
+        if step.type == "tool_calls":
+            for tool_call in step.step_details.tool_calls:
+                name = tool_call.function.name if tool_call.type == "function" else tool_call.type
+                if f"{tool_call.id}:started" not in seen:
+                    seen.add(f"{tool_call.id}:started")
+                    yield ("tool", ResponseMessage(role="tool", content=f"{name} started"))
+                if step.status == "completed" and f"{tool_call.id}:completed" not in seen:
+                    seen.add(f"{tool_call.id}:completed")
+                    yield ("tool", ResponseMessage(role="tool", content=f"{name} completed"))
+        elif step.type == "message_creation" and step.status == "completed":
+            message_id = step.step_details.message_creation.message_id
+            if message_id in seen:
+                continue
+            seen.add(message_id)
+            cursor[0] = message_id
+            message = await client.beta.threads.messages.retrieve(
+                message_id, thread_id=thread.id)
+            for response_message in await __messages_to_responses(client, [message], user_name):
+                yield ("message", response_message)
+
+
+async def __cancel_run(client, thread, run_id: str):
+    # Cancel the run and wait until it stopped
+    try:
+        await client.beta.threads.runs.cancel(thread_id=thread.id, run_id=run_id)
+        poller = runpoller.Instance()
+        await poller.wait(client, thread.id, run_id, poller.deadline())
+    except Exception as e:
+        logging.warning(f"Unable to cancel run {run_id}: {e}")
 
 
-def delete_assistant(client, user_name) -> str | None:
+async def stream_prompt(client, assistant, thread, prompt, email_uri, user_name: str):
+    """Process a prompt and yield (event, ResponseMessage) pairs as the run progresses.
+
+    Events are status (run status changes), tool (tool calls starting and
+    finishing), message (assistant text and images) and done.
+    """
+    poller = runpoller.Instance()
+    deadline = poller.deadline()
+    try:
+        with metrics.timed("message_create"):
+            message = await __when_thread_free(client, thread, deadline, lambda: client.beta.threads.messages.create(
+                thread_id=thread.id,
+                role="user",
+                content=prompt
+            ))
+    except runpoller.RunTimeoutError:
+        logging.warning(f"Thread {thread.id} stayed busy for user {user_name}")
+        yield ("done", ResponseMessage(role="system", content="expired"))
+        return
+    yield ("message", ResponseMessage(role="user", content=prompt))
+    # Move the thread cursor along with the messages sent
+    cursor = [message.id]
+
+    try:
+        run = await __create_run(client, assistant, thread, deadline)
+    except runpoller.RunTimeoutError:
+        logging.warning(f"Thread {thread.id} stayed busy for user {user_name}")
+        kvstore.set_thread_cursor(user_name, cursor[0])
+        yield ("done", ResponseMessage(role="system", content="expired"))
+        return
+    status = None
+    seen = set()
+    finished = False
+    try:
+        while True:
+            try:
+                async for run in poller.watch(client, thread.id, run.id, deadline):
+                    if run.status != status:
+                        status = run.status
+                        yield ("status", ResponseMessage(role="system", content=status))
+                    async for event in __stream_run_steps(client, thread, run, seen, cursor, user_name):
+                        yield event
+            except runpoller.RunTimeoutError:
+                logging.warning(
+                    f"Run {run.id} timed out for user {user_name}, cancelling it")
+                try:
+                    await client.beta.threads.runs.cancel(
+                        thread_id=thread.id, run_id=run.id)
+                except:
+                    logging.warning(f"Unable to cancel run: {run.id}")
+                status = "expired"
+                break
+            if run.status != "requires_action":
+                break
+            await call_functions(client, thread, run, email_uri)
+        finished = True
+    finally:
+        if not finished:
+            # The client went away or the stream failed mid-run, stop the run so
+            # that it does not keep the thread busy. The task finishes even if
+            # this one is cancelled again while waiting for it.
+            logging.info(f"Stream closed for user {user_name}, cancelling run {run.id}")
+            await asyncio.shield(asyncio.ensure_future(__cancel_run(client, thread, run.id)))
+
+    kvstore.set_thread_cursor(user_name, cursor[0])
+    yield ("done", ResponseMessage(role="system", content=status))
+
+
+async def delete_assistant(client, user_name) -> str | None:
     # Get the Assistant settings for the user
     user_assistant_settings = kvstore.get_user(user_name)
     if user_assistant_settings is None or user_assistant_settings == []:
         return "User not found"
-    try:
-        # Delete all the used objects
-        for setting in user_assistant_settings:
-            if setting.key == "assistant":
-                try:
-                    client.beta.assistants.delete(setting.value)
-                except:
-                    logging.warning(
-                        f"Unable to delete assistant: {setting.value}")
-            elif setting.key == "thread":
-                try:
-                    client.beta.threads.delete(setting.value)
-                except:
-                    logging.warning(
-                        f"Unable to delete thread: {setting.value}")
-            elif setting.key == "file":
-                json_data = json.loads(setting.value)
-                try:
-                    client.files.delete(json_data['id'])
-                except:
-                    logging.warning(
-                        f"Unable to delete file: {json_data['id']}")
-    except:
-        pass
-    try:
-        (new_path, _) = __user_folders(user_name)
-        shutil.rmtree(new_path)
-    except:
-        logging.warning(
-            f"Unable to delete the image folder for user {user_name}")
+    # Collect the used objects, then delete them all at once
+    deletes = []
+    for setting in user_assistant_settings:
+        if setting.key == "assistant":
+            # Shared Assistants are deleted when their last user goes away
+            refs = kvstore.release_assistant(setting.value, user_name)
+            if refs > 0:
+                logging.info(
+                    f"Keeping assistant {setting.value} shared with {refs} other user(s)")
+                continue
+            deletes.append(__delete_remote(
+                "assistant", setting.value, client.beta.assistants.delete))
+        elif setting.key == "thread":
+            deletes.append(__delete_remote(
+                "thread", setting.value, client.beta.threads.delete))
+        elif setting.key == "file":
+            json_data = json.loads(setting.value)
+            # Shared files are deleted when their last owner goes away
+            refs = kvstore.release_file(json_data['id'], user_name)
+            if refs > 0:
+                logging.info(
+                    f"Keeping file {json_data['id']} used by {refs} other assistant(s)")
+                continue
+            deletes.append(__delete_remote(
+                "file", json_data['id'], client.files.delete))
+    await asyncio.gather(*deletes)
+    for setting in user_assistant_settings:
+        if setting.key == "id":
+            await images.Instance().delete_user(setting.value)
     return None
@@ -0,0 +1,113 @@
+import json
+import logging
+import threading
+from concurrent.futures import Future
+
+import settings
+from cache import MISSING, TTLCache
+
+config = settings.Instance()
+
+# Latest closing prices shared by all users
+cache = TTLCache(config.quote_cache_size, config.quote_cache_ttl)
+
+# Symbols being fetched, so concurrent lookups wait for one request
+in_flight: dict[str, Future] = {}
+lock = threading.Lock()
+
+fixture = None
+
+
+def __fixture_quotes(symbols: list[str]) -> dict[str, float]:
+    # Offline stand-in for Yahoo Finance, a JSON object of symbol to price
+    global fixture
+    if fixture is None:
+        with open(config.quotes_fixture) as f:
+            fixture = {symbol.upper(): float(price)
+                       for (symbol, price) in json.load(f).items()}
+    return {symbol: fixture[symbol] for symbol in symbols if symbol in fixture}
+
+
+def __fetch_quotes(symbols: list[str]) -> dict[str, float]:
+    if config.quotes_fixture:
+        return __fixture_quotes(symbols)
+    logging.info(f"Getting stock prices for {', '.join(symbols)}")
+    # yfinance pulls in pandas, only import it once a price is needed
+    import yfinance as yf
+    if len(symbols) == 1:
+        history = yf.Ticker(symbols[0]).history(period="1d")
+        if history.empty:
+            return {}
+        return {symbols[0]: float(history['Close'].iloc[-1])}
+    # One bulk download for all the symbols
+    data = yf.download(symbols, period="1d", progress=False)
+    closes = data['Close']
+    if closes.ndim == 1:
+        closes = closes.to_frame(symbols[0])
+    prices = {}
+    for symbol in symbols:
+        if symbol in closes:
+            column = closes[symbol].dropna()
+            if not column.empty:
+                prices[symbol] = float(column.iloc[-1])
+    return prices
+
+
+def get_quotes(symbols: list[str]) -> dict[str, float]:
+    """Return the latest closing price of each symbol that could be found.
+
+    Cached prices are used for up to QUOTE_CACHE_TTL seconds, and symbols
+    that are already being fetched by another call are waited for.
+    """
+    symbols = list(dict.fromkeys(symbol.strip().upper() for symbol in symbols))
+    prices = {}
+    fetch = []
+    waits = {}
+    with lock:
+        for symbol in symbols:
+            price = cache.get(symbol)
+            if price is not MISSING:
+                prices[symbol] = price
+            elif symbol in in_flight:
+                waits[symbol] = in_flight[symbol]
+            else:
+                in_flight[symbol] = Future()
+                fetch.append(symbol)
+
+    if fetch != []:
+        error = None
+        try:
+            fetched = __fetch_quotes(fetch)
+        except Exception as e:
+            logging.error(f"Unable to get stock prices: {e}")
+            fetched = {}
+            error = e
+        with lock:
+            for symbol in fetch:
+                future = in_flight.pop(symbol)
+                if symbol in fetched:
+                    cache.set(symbol, fetched[symbol])
+                    prices[symbol] = fetched[symbol]
+                    future.set_result(fetched[symbol])
+                else:
+                    future.set_exception(
+                        error or LookupError(f"No price found for {symbol}"))
+
+    for (symbol, future) in waits.items():
+        try:
+            prices[symbol] = future.result()
+        except Exception:
+            pass
+    return prices
+
+
+def get_quote(symbol: str) -> float:
+    symbol = symbol.strip().upper()
+    prices = get_quotes([symbol])
+    if symbol not in prices:
+        raise LookupError(f"No price found for {symbol}")
+    return prices[symbol]
+
+
+def stats() -> dict:
+    return cache.stats()
@@ -0,0 +1,198 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+
+import httpx
+
+import metrics
+
+# Responses worth sending again, the same ones the openai SDK retries
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# Responses that mean the deployment is over its quota
+THROTTLE_STATUS_CODES = {429, 503}
+# Path segments followed by an id, the ids are left out of the metric labels
+ID_SEGMENTS = {"assistants", "threads", "runs",
+               "messages", "files", "steps", "deployments"}
+
+
+class AdaptiveLimiter:
+    """Paces the requests to one service with a token bucket and a concurrency limit.
+
+    The bucket allows rate requests per second with bursts of up to burst
+    requests (rate 0 disables it). The concurrency limit is halved when the
+    service throttles and grows back by one after each window of successful
+    requests. A Retry-After from the service pauses every request.
+    """
+
+    def __init__(self, rate: float, burst: int, max_concurrency: int, min_concurrency: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.waiting = 0
+        self.throttled = 0
+        self.retries = 0
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._condition: asyncio.Condition | None = None
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        self.waiting += 1
+        try:
+            await self.__take_token()
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.in_flight < self.limit)
+                self.in_flight += 1
+        finally:
+            self.waiting -= 1
+
+    async def release(self, throttled: bool, retry_after: float | None = None):
+        now = time.monotonic()
+        if throttled:
+            self.throttled += 1
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            # Back off at most once per second so a burst of 429s halves the limit once
+            if now - self._last_decrease >= 1:
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                self._last_decrease = now
+                self._successes = 0
+                logging.warning(
+                    f"Azure OpenAI is throttling, lowering the concurrency to {self.limit}")
+        else:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "in_flight": self.in_flight, "waiting": self.waiting,
+                "throttled": self.throttled, "retries": self.retries}
+
+    async def __take_token(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if self.rate <= 0:
+                return
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def retry_after(response: httpx.Response) -> float | None:
+    """The delay the service asked for, in seconds."""
+    for header in ("retry-after-ms", "x-ms-retry-after-ms"):
+        try:
+            return float(response.headers[header]) / 1000
+        except (KeyError, ValueError):
+            pass
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def operation(request: httpx.Request) -> str:
+    """The request method and path with its ids replaced, e.g. GET /threads/{id}/runs/{id}."""
+    segments = request.url.path.split("/")
+    for i in range(1, len(segments)):
+        if segments[i - 1] in ID_SEGMENTS and segments[i]:
+            segments[i] = "{id}"
+    path = "/".join(segments)
+    # Drop the /openai prefix of the Azure endpoints
+    if path.startswith("/openai/"):
+        path = path[len("/openai"):]
+    return f"{request.method} {path}"
+
+
+class ThrottledTransport(httpx.AsyncBaseTransport):
+    """Sends the requests through an AdaptiveLimiter and retries the throttled ones.
+
+    Retries wait for the Retry-After of the response, or an exponential
+    backoff with full jitter, capped at max_retry_delay seconds.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiter: AdaptiveLimiter,
+                 retries: int, retry_delay: float, max_retry_delay: float):
+        self._transport = transport
+        self.limiter = limiter
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        try:
+            response = await self.__send(request)
+        except BaseException as e:
+            self.__observe(request, start, type(e).__name__)
+            raise
+        self.__observe(request, start, response.status_code)
+        return response
+
+    async def __send(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire()
+            try:
+                response = await self._transport.handle_async_request(request)
+            except httpx.TransportError as e:
+                await self.limiter.release(False)
+                if attempt == self.retries:
+                    raise
+                delay = self.__backoff(attempt)
+                logging.warning(
+                    f"{request.method} {request.url.path} failed ({e}), retrying in {delay:.2f}s")
+            except BaseException:
+                await self.limiter.release(False)
+                raise
+            else:
+                delay = retry_after(response)
+                await self.limiter.release(response.status_code in THROTTLE_STATUS_CODES, delay)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                    return response
+                await response.aclose()
+                if delay is None:
+                    delay = self.__backoff(attempt)
+                delay = min(delay, self.max_retry_delay)
+                logging.warning(
+                    f"{request.method} {request.url.path} returned {response.status_code}, retrying in {delay:.2f}s")
+            self.limiter.retries += 1
+            metrics.azure_retries.inc(operation(request))
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+    def __observe(self, request: httpx.Request, start: float, status):
+        elapsed = time.perf_counter() - start
+        metrics.azure_requests.observe(elapsed, operation(request), status)
+        metrics.add_timing("azure", elapsed)
+
+    def __backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_retry_delay, self.retry_delay * (2 ** attempt)))
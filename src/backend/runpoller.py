@@ -0,0 +1,192 @@
+import asyncio
+import contextvars
+import logging
+import time
+
+import metrics
+import settings
+
+# Run states that need the caller's attention. Anything else (queued,
+# in_progress, cancelling) keeps the run in the polling schedule.
+ACTIONABLE_STATES = {"requires_action", "completed",
+                     "failed", "expired", "cancelled"}
+
+
+class RunTimeoutError(Exception):
+    pass
+
+
+class _PendingRun:
+    __slots__ = ("client", "thread_id", "run_id", "future", "on_poll",
+                 "interval", "due", "deadline", "polls", "timings")
+
+    def __init__(self, client, thread_id: str, run_id: str, future: asyncio.Future, on_poll,
+                 interval: float, due: float, deadline: float):
+        self.client = client
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.future = future
+        self.on_poll = on_poll
+        self.interval = interval
+        self.due = due
+        self.deadline = deadline
+        self.polls = 0
+        # The Server-Timing of the request waiting for the run
+        self.timings = metrics.request_timings.get()
+
+
+class RunPoller:
+    """Polls the status of every active run from a single scheduler task.
+
+    Each run backs off on its own schedule (fast first polls, then longer
+    gaps). On every tick the runs that are due are retrieved together and the
+    waiters are woken once their run reaches an actionable state.
+    """
+
+    def __init__(self, initial_interval: float, max_interval: float, backoff: float, run_timeout: float):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.run_timeout = run_timeout
+        self._runs: dict[str, _PendingRun] = {}
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def deadline(self) -> float:
+        """The absolute deadline for a run that starts now."""
+        return asyncio.get_running_loop().time() + self.run_timeout
+
+    async def wait(self, client, thread_id: str, run_id: str, deadline: float):
+        """Wait until the run needs attention and return it.
+
+        deadline is an absolute event loop time. RunTimeoutError is raised
+        once it passes.
+        """
+        future = self.__register(client, thread_id, run_id, deadline, None)
+        try:
+            return await future
+        finally:
+            self.__finish(run_id)
+
+    async def watch(self, client, thread_id: str, run_id: str, deadline: float):
+        """Yield the run after every poll until it needs attention.
+
+        The last run yielded is the one in an actionable state.
+        """
+        updates = asyncio.Queue()
+        future = self.__register(client, thread_id, run_id,
+                                 deadline, updates.put_nowait)
+        try:
+            while not future.done() or not updates.empty():
+                update = asyncio.ensure_future(updates.get())
+                await asyncio.wait({update, future}, return_when=asyncio.FIRST_COMPLETED)
+                if update.done():
+                    yield update.result()
+                else:
+                    update.cancel()
+            # Raise RunTimeoutError if the deadline passed
+            future.result()
+        finally:
+            self.__finish(run_id)
+
+    def active_runs(self) -> int:
+        return len(self._runs)
+
+    def __register(self, client, thread_id: str, run_id: str, deadline: float, on_poll) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._runs[run_id] = _PendingRun(client, thread_id, run_id, future, on_poll,
+                                         self.initial_interval, loop.time() + self.initial_interval, deadline)
+        self.__ensure_scheduler()
+        self._wakeup.set()
+        return future
+
+    def __finish(self, run_id: str):
+        pending = self._runs.pop(run_id, None)
+        if not self._runs and self._wakeup is not None:
+            # Let the parked scheduler exit
+            self._wakeup.set()
+        if pending is None or not pending.future.done():
+            return
+        if pending.future.cancelled():
+            status = "cancelled"
+        elif pending.future.exception() is not None:
+            status = "timeout"
+        else:
+            status = pending.future.result().status
+        metrics.run_polls.observe(pending.polls, status)
+
+    def __ensure_scheduler(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            # Not in the context of the request that started it, each poll is
+            # timed for the request waiting for that run
+            self._task = asyncio.create_task(
+                self.__schedule(), context=contextvars.Context())
+
+    async def __schedule(self):
+        loop = asyncio.get_running_loop()
+        while self._runs:
+            now = loop.time()
+            due = []
+            for pending in list(self._runs.values()):
+                if pending.future.done():
+                    continue
+                if now >= pending.deadline:
+                    pending.future.set_exception(RunTimeoutError(
+                        f"Run {pending.run_id} did not finish before its deadline"))
+                elif now >= pending.due:
+                    due.append(pending)
+
+            if due:
+                await asyncio.gather(*[self.__poll(pending) for pending in due])
+
+            # Sleep until the next run is due, or until a run is registered or removed
+            now = loop.time()
+            waiting = [min(pending.due, pending.deadline)
+                       for pending in self._runs.values() if not pending.future.done()]
+            self._wakeup.clear()
+            if not waiting:
+                # Only finished runs are left, their waiters remove them
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, min(waiting) - now))
+            except asyncio.TimeoutError:
+                pass
+
+    async def __poll(self, pending: _PendingRun):
+        pending.polls += 1
+        start = time.perf_counter()
+        try:
+            run = await pending.client.beta.threads.runs.retrieve(
+                thread_id=pending.thread_id, run_id=pending.run_id)
+        except Exception as e:
+            logging.warning(f"Unable to retrieve run {pending.run_id}: {e}")
+            run = None
+        metrics.add_timing("azure", time.perf_counter() - start, pending.timings)
+
+        if pending.future.done():
+            return
+        if run is not None and pending.on_poll is not None:
+            pending.on_poll(run)
+        if run is not None and run.status in ACTIONABLE_STATES:
+            pending.future.set_result(run)
+            return
+        # Still running, back off before the next poll
+        loop = asyncio.get_running_loop()
+        pending.interval = min(pending.interval * self.backoff, self.max_interval)
+        pending.due = loop.time() + pending.interval
+
+
+poller = None
+
+
+def Instance() -> RunPoller:
+    global poller
+    if poller is None:
+        config = settings.Instance()
+        poller = RunPoller(config.run_poll_interval,
+                           config.run_poll_max_interval, config.run_poll_backoff, config.run_timeout)
+    return poller
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import kvstore
+import settings
+
+# First and longest wait between attempts to lock a thread held by another worker (seconds)
+LOCK_RETRY_DELAY = 0.1
+LOCK_MAX_RETRY_DELAY = 1.0
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class _Batch:
+    __slots__ = ("prompts", "future", "waiters", "task")
+
+    def __init__(self, prompt: str, future: asyncio.Future):
+        self.prompts = [prompt]
+        self.future = future
+        # Callers still waiting for the result
+        self.waiters = 1
+        self.task: asyncio.Task | None = None
+
+
+class _Line:
+    __slots__ = ("lock", "pending", "batch")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+        self.batch: _Batch | None = None
+
+
+class RunQueue:
+    """Lets one run at a time use a thread, in the order the prompts arrived.
+
+    Prompts sent to a busy thread wait in line. The ones that arrive while
+    the previous run is still going are sent together and answered by a
+    single run, which waits merge_window seconds for more when other prompts
+    are in line. A prompt sent to an idle thread runs right away. Past
+    max_pending waiting prompts QueueFullError is raised right away.
+
+    The line only orders the prompts of this worker. A run also holds the
+    thread's lock in the kvstore, renewed while it runs, so the runs of
+    other workers on the thread wait for it. A lock that was not renewed
+    for lease seconds is taken over.
+    """
+
+    def __init__(self, merge_window: float, max_pending: int, lease: float):
+        self.merge_window = merge_window
+        self.max_pending = max_pending
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lines: dict[str, _Line] = {}
+
+    async def submit(self, thread_id: str, prompt: str, process):
+        """Run process(prompts) on the thread and return its result.
+
+        prompts holds this prompt and any others merged with it, every
+        caller of a merged run gets the same result.
+        """
+        line = self.__enter(thread_id)
+        batch = line.batch
+        if batch is None:
+            # The run is a task of its own that keeps this caller's place in
+            # line, so cancelling the caller does not cancel the merged prompts
+            batch = line.batch = _Batch(
+                prompt, asyncio.get_running_loop().create_future())
+            batch.task = asyncio.create_task(
+                self.__run(thread_id, line, batch, process))
+            leave = False
+        else:
+            # Join the prompts waiting for the next run
+            batch.prompts.append(prompt)
+            batch.waiters += 1
+            leave = True
+        try:
+            return await asyncio.shield(batch.future)
+        except asyncio.CancelledError:
+            batch.waiters -= 1
+            if line.batch is batch:
+                # Not sent yet
+                batch.prompts.remove(prompt)
+            if batch.waiters == 0:
+                batch.task.cancel()
+            raise
+        finally:
+            if leave:
+                self.__leave(thread_id, line)
+
+    @asynccontextmanager
+    async def exclusive(self, thread_id: str):
+        """Wait for the thread to be free and keep it for the block, without merging."""
+        line = self.__enter(thread_id)
+        try:
+            async with line.lock, self.__locked(thread_id):
+                yield
+        finally:
+            self.__leave(thread_id, line)
+
+    @asynccontextmanager
+    async def __locked(self, thread_id: str):
+        # Wait for the runs of the other workers on the thread
+        delay = LOCK_RETRY_DELAY
+        while not self.__lock(thread_id):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LOCK_MAX_RETRY_DELAY)
+        renew = asyncio.create_task(self.__renew(thread_id))
+        try:
+            yield
+        finally:
+            renew.cancel()
+            kvstore.unlock_thread(thread_id, self.owner)
+
+    def __lock(self, thread_id: str) -> bool:
+        now = time.time()
+        return kvstore.lock_thread(thread_id, self.owner, now, now - self.lease)
+
+    async def __renew(self, thread_id: str):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            self.__lock(thread_id)
+
+    async def __run(self, thread_id: str, line: _Line, batch: _Batch, process):
+        try:
+            async with line.lock, self.__locked(thread_id):
+                if self.merge_window > 0 and line.pending > 1:
+                    # The thread is busy, let the prompts close together share the run
+                    await asyncio.sleep(self.merge_window)
+                # Later prompts go to the next run
+                line.batch = None
+                result = await process(batch.prompts)
+            batch.future.set_result(result)
+        except asyncio.CancelledError:
+            batch.future.cancel()
+            raise
+        except Exception as e:
+            batch.future.set_exception(e)
+            # Mark it retrieved, the callers re-raise it
+            batch.future.exception()
+        finally:
+            if line.batch is batch:
+                line.batch = None
+            self.__leave(thread_id, line)
+
+    def pending(self) -> int:
+        return sum(line.pending for line in self._lines.values())
+
+    def __enter(self, thread_id: str) -> _Line:
+        line = self._lines.get(thread_id)
+        if line is None:
+            line = self._lines[thread_id] = _Line()
+        if line.pending >= self.max_pending:
+            raise QueueFullError(
+                f"Too many prompts waiting for thread {thread_id}")
+        line.pending += 1
+        return line
+
+    def __leave(self, thread_id: str, line: _Line):
+        line.pending -= 1
+        if line.pending == 0:
+            self._lines.pop(thread_id, None)
+
+
+queue = None
+
+
+def Instance() -> RunQueue:
+    global queue
+    if queue is None:
+        config = settings.Instance()
+        queue = RunQueue(config.run_merge_window, config.run_queue_limit,
+                         config.thread_lock_lease)
+    return queue
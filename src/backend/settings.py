@@ -13,6 +13,103 @@ class Settings:
         self.api_deployment_name = os.getenv("OPENAI_GPT_DEPLOYMENT")
         self.email_URI = os.getenv("EMAIL_URI")
         self.deploy_spa = os.getenv("DEPLOY_SPA")
+        # Run polling: first poll delay, backoff factor, longest gap and overall deadline (seconds)
+        self.run_poll_interval = float(os.getenv("RUN_POLL_INTERVAL", "0.5"))
+        self.run_poll_backoff = float(os.getenv("RUN_POLL_BACKOFF", "1.5"))
+        self.run_poll_max_interval = float(
+            os.getenv("RUN_POLL_MAX_INTERVAL", "5"))
+        self.run_timeout = float(os.getenv("RUN_TIMEOUT", "600"))
+        # Shared HTTP connection pool for the Azure OpenAI clients
+        self.http_max_connections = int(
+            os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+        self.http_max_keepalive = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+        self.http_keepalive_expiry = float(
+            os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+        self.http_timeout = float(os.getenv("HTTP_TIMEOUT", "60"))
+        # File ingestion: parallel downloads/uploads and retries of the downloads
+        self.ingest_concurrency = int(os.getenv("INGEST_CONCURRENCY", "4"))
+        self.ingest_retries = int(os.getenv("INGEST_RETRIES", "2"))
+        self.ingest_retry_delay = float(
+            os.getenv("INGEST_RETRY_DELAY", "1"))
+        # Tool calls: worker threads shared by all runs and the deadline of each call
+        self.tool_workers = int(os.getenv("TOOL_WORKERS", "16"))
+        self.tool_timeout = float(os.getenv("TOOL_TIMEOUT", "30"))
+        # Stock quotes: cache size, freshness and an optional offline fixture (JSON of symbol to price)
+        self.quote_cache_size = int(os.getenv("QUOTE_CACHE_SIZE", "1000"))
+        self.quote_cache_ttl = float(os.getenv("QUOTE_CACHE_TTL", "60"))
+        self.quotes_fixture = os.getenv("QUOTES_FIXTURE")
+        # Page size when listing the new thread messages
+        self.message_page_size = int(os.getenv("MESSAGE_PAGE_SIZE", "20"))
+        # Parallel image downloads per response
+        self.image_download_concurrency = int(
+            os.getenv("IMAGE_DOWNLOAD_CONCURRENCY", "4"))
+        # Disk space for the saved response images, least recently used ones are evicted (bytes, 0 for no limit)
+        self.image_cache_bytes = int(
+            os.getenv("IMAGE_CACHE_BYTES", "1073741824"))
+        # In-memory cache in front of the kvstore lookups
+        self.kvstore_cache_size = int(os.getenv("KVSTORE_CACHE_SIZE", "10000"))
+        self.kvstore_cache_ttl = float(os.getenv("KVSTORE_CACHE_TTL", "300"))
+        # How long a retrieved Assistant or thread is trusted before it is retrieved again
+        self.validated_cache_size = int(
+            os.getenv("VALIDATED_CACHE_SIZE", "10000"))
+        self.validated_cache_ttl = float(
+            os.getenv("VALIDATED_CACHE_TTL", "300"))
+        # Share one Assistant between the users with the same instructions, tools and files
+        self.shared_assistants = os.getenv(
+            "SHARED_ASSISTANTS", "False") == "True"
+        # Empty threads kept ready for new users: pool size, age before recycling and refill period (seconds)
+        self.thread_pool_size = int(os.getenv("THREAD_POOL_SIZE", "5"))
+        self.thread_pool_ttl = float(os.getenv("THREAD_POOL_TTL", "3600"))
+        self.thread_pool_refill_interval = float(
+            os.getenv("THREAD_POOL_REFILL_INTERVAL", "30"))
+        # Users deleted in parallel by the bulk teardown job
+        self.teardown_concurrency = int(
+            os.getenv("TEARDOWN_CONCURRENCY", "16"))
+        # Workers running the queued /api/create jobs
+        self.create_workers = int(os.getenv("CREATE_WORKERS", "4"))
+        # A job is resumed by another worker when its lease is not renewed for this long (seconds)
+        self.job_lease = float(os.getenv("JOB_LEASE", "60"))
+        # Prompts per thread: how long to wait for more prompts to merge into a run (seconds) and how many may wait
+        self.run_merge_window = float(os.getenv("RUN_MERGE_WINDOW", "0.1"))
+        self.run_queue_limit = int(os.getenv("RUN_QUEUE_LIMIT", "5"))
+        # Another worker takes over the lock on a thread when it is not renewed for this long (seconds)
+        self.thread_lock_lease = float(os.getenv("THREAD_LOCK_LEASE", "30"))
+        # Worker processes uvicorn runs (it reads WEB_CONCURRENCY too), they share the Azure OpenAI quota
+        self.web_concurrency = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+        # Azure OpenAI calls: requests per minute of the deployment quota (0 for no limit), burst size,
+        # concurrency bounds while throttled, all split between the workers,
+        # and the retries of throttled or failed calls (seconds)
+        self.openai_requests_per_minute = float(
+            os.getenv("OPENAI_REQUESTS_PER_MINUTE", "0"))
+        self.openai_burst = int(os.getenv("OPENAI_BURST", "10"))
+        self.openai_max_concurrency = int(
+            os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+        self.openai_min_concurrency = int(
+            os.getenv("OPENAI_MIN_CONCURRENCY", "2"))
+        self.openai_retries = int(os.getenv("OPENAI_RETRIES", "4"))
+        self.openai_retry_delay = float(
+            os.getenv("OPENAI_RETRY_DELAY", "0.5"))
+        self.openai_max_retry_delay = float(
+            os.getenv("OPENAI_MAX_RETRY_DELAY", "30"))
+        # Email outbox: emails sent per batch, delivery attempts, first retry delay and idle poll period (seconds)
+        self.outbox_batch_size = int(os.getenv("OUTBOX_BATCH_SIZE", "10"))
+        self.outbox_max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+        self.outbox_retry_delay = float(
+            os.getenv("OUTBOX_RETRY_DELAY", "5"))
+        self.outbox_poll_interval = float(
+            os.getenv("OUTBOX_POLL_INTERVAL", "30"))
+        # Email outbox: claims not sent within this long are sent by another worker, sent and failed emails are kept this long (seconds)
+        self.outbox_lease = float(os.getenv("OUTBOX_LEASE", "300"))
+        self.outbox_retention = float(
+            os.getenv("OUTBOX_RETENTION", "604800"))
+        # Local country index used by get_country_data and how often it is downloaded again (seconds, 0 for never)
+        self.countries_snapshot = os.getenv(
+            "COUNTRIES_SNAPSHOT", "data/countries.json")
+        self.countries_refresh_interval = float(
+            os.getenv("COUNTRIES_REFRESH_INTERVAL", "604800"))
+        # Add the stage timings of each request as a Server-Timing header
+        self.metrics_server_timing = os.getenv(
+            "METRICS_SERVER_TIMING", "True") == "True"
 
 
 settings = None
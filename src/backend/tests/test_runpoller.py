@@ -0,0 +1,99 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+import runpoller
+
+
+class FakeRuns:
+    """runs.retrieve that reports the run in progress until the last poll."""
+
+    def __init__(self, polls_until_done: int):
+        self.polls_until_done = polls_until_done
+        self.polls = 0
+
+    async def retrieve(self, thread_id: str, run_id: str):
+        self.polls += 1
+        status = "completed" if self.polls >= self.polls_until_done else "in_progress"
+        return SimpleNamespace(id=run_id, thread_id=thread_id, status=status)
+
+
+def fake_client(runs: FakeRuns):
+    return SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs)))
+
+
+def count_iterations(loop: asyncio.AbstractEventLoop) -> list[int]:
+    # Every pass of the event loop goes through _run_once
+    iterations = [0]
+    run_once = loop._run_once
+
+    def counting_run_once():
+        iterations[0] += 1
+        run_once()
+    loop._run_once = counting_run_once
+    return iterations
+
+
+def test_scheduler_parks_while_a_watch_consumer_is_busy():
+    async def main():
+        loop = asyncio.get_running_loop()
+        iterations = count_iterations(loop)
+        poller = runpoller.RunPoller(0.01, 0.01, 1, 10)
+        runs = FakeRuns(polls_until_done=2)
+        statuses = []
+        busy_iterations = None
+        async for run in poller.watch(fake_client(runs), "thread", "run", loop.time() + 5):
+            statuses.append(run.status)
+            if run.status == "completed":
+                # The run stays registered while the consumer does other I/O
+                start = iterations[0]
+                await asyncio.sleep(0.2)
+                busy_iterations = iterations[0] - start
+        await asyncio.sleep(0)
+        return (statuses, runs.polls, busy_iterations, poller)
+
+    (statuses, polls, busy_iterations, poller) = asyncio.run(main())
+    assert statuses == ["in_progress", "completed"]
+    assert polls == 2
+    # A scheduler spinning on sleep(0) runs tens of thousands of iterations in 200 ms
+    assert busy_iterations < 20
+    assert poller.active_runs() == 0
+    assert poller._task.done()
+
+
+def test_wait_returns_the_actionable_run():
+    async def main():
+        loop = asyncio.get_running_loop()
+        poller = runpoller.RunPoller(0.01, 0.05, 2, 10)
+        runs = FakeRuns(polls_until_done=3)
+        run = await poller.wait(fake_client(runs), "thread", "run", loop.time() + 5)
+        return (run, runs.polls, poller)
+
+    (run, polls, poller) = asyncio.run(main())
+    assert run.status == "completed"
+    assert polls == 3
+    assert poller.active_runs() == 0
+
+
+def test_each_waiter_gets_the_timings_of_its_polls():
+    async def main():
+        loop = asyncio.get_running_loop()
+        poller = runpoller.RunPoller(0.01, 0.01, 1, 10)
+        runs = [FakeRuns(polls_until_done=2), FakeRuns(polls_until_done=5)]
+
+        async def request(runs: FakeRuns, run_id: str) -> dict:
+            # What the Server-Timing middleware does for each request
+            timings = {}
+            metrics.request_timings.set(timings)
+            await poller.wait(fake_client(runs), "thread", run_id, loop.time() + 5)
+            return timings
+
+        return await asyncio.gather(request(runs[0], "first"), request(runs[1], "second"))
+
+    (first, second) = asyncio.run(main())
+    assert first["azure"][1] == 2
+    assert second["azure"][1] == 5
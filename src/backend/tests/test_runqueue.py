@@ -0,0 +1,139 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kvstore
+import runqueue
+
+
+def setup_module():
+    kvstore.create_store(os.path.join(tempfile.mkdtemp(), "kvstore.db"))
+
+
+def test_prompt_to_an_idle_thread_does_not_wait_for_the_merge_window():
+    async def main():
+        queue = runqueue.RunQueue(5, 10, 30)
+
+        async def process(prompts):
+            return prompts
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        result = await queue.submit("thread", "hello", process)
+        return (result, loop.time() - start, queue)
+
+    (result, elapsed, queue) = asyncio.run(main())
+    assert result == ["hello"]
+    assert elapsed < 1
+    assert queue.pending() == 0
+
+
+def test_prompts_sent_to_a_busy_thread_share_a_run():
+    async def main():
+        queue = runqueue.RunQueue(0.01, 10, 30)
+        batches = []
+        release = asyncio.Event()
+
+        async def process(prompts):
+            batches.append(list(prompts))
+            await release.wait()
+            return len(batches)
+
+        first = asyncio.create_task(queue.submit("thread", "a", process))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(queue.submit("thread", "b", process))
+        third = asyncio.create_task(queue.submit("thread", "c", process))
+        await asyncio.sleep(0)
+        release.set()
+        return (await asyncio.gather(first, second, third), batches)
+
+    (results, batches) = asyncio.run(main())
+    assert batches == [["a"], ["b", "c"]]
+    assert results == [1, 2, 2]
+
+
+def test_cancelling_the_first_caller_keeps_the_merged_run_going():
+    async def main():
+        queue = runqueue.RunQueue(0.01, 10, 30)
+        batches = []
+        busy = asyncio.Event()
+        release = asyncio.Event()
+
+        async def process(prompts):
+            batches.append(list(prompts))
+            if len(batches) == 1:
+                busy.set()
+            await release.wait()
+            return len(batches)
+
+        first = asyncio.create_task(queue.submit("thread", "a", process))
+        await busy.wait()
+        # b leads the next run, c joins it
+        leader = asyncio.create_task(queue.submit("thread", "b", process))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(queue.submit("thread", "c", process))
+        await asyncio.sleep(0)
+        leader.cancel()
+        release.set()
+        results = await asyncio.gather(first, leader, follower, return_exceptions=True)
+        return (results, batches, queue)
+
+    (results, batches, queue) = asyncio.run(main())
+    assert results[0] == 1
+    assert isinstance(results[1], asyncio.CancelledError)
+    assert results[2] == 2
+    # The cancelled prompt was not sent yet, so it is left out of the run
+    assert batches == [["a"], ["c"]]
+    assert queue.pending() == 0
+
+
+def test_cancelling_every_caller_cancels_the_run():
+    async def main():
+        queue = runqueue.RunQueue(0, 10, 30)
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def process(prompts):
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.create_task(queue.submit("thread", "a", process))
+        await started.wait()
+        caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        return queue
+
+    queue = asyncio.run(main())
+    assert queue.pending() == 0
+
+
+def test_workers_take_turns_on_a_thread():
+    async def main():
+        # Two queues stand for two worker processes
+        workers = [runqueue.RunQueue(0, 10, 30), runqueue.RunQueue(0, 10, 30)]
+        running = []
+        overlaps = []
+
+        async def process(prompts):
+            running.append(prompts[0])
+            overlaps.append(len(running))
+            await asyncio.sleep(0.05)
+            running.remove(prompts[0])
+            return prompts[0]
+
+        results = await asyncio.gather(workers[0].submit("shared", "a", process),
+                                       workers[1].submit("shared", "b", process))
+        return (results, overlaps)
+
+    (results, overlaps) = asyncio.run(main())
+    assert results == ["a", "b"]
+    assert overlaps == [1, 1]
+    assert kvstore.conn.execute("SELECT COUNT(*) FROM thread_locks").fetchone()[0] == 0
@@ -1,100 +1,189 @@
+import asyncio
+import functools
 import html
-from pydantic import BaseModel
-import yfinance as yf
-import requests
+import json
+import clients
+import countries
+import kvstore
+import outbox
+import settings
+import quotes
 import logging
 
 
 def get_stock_price(symbol: str) -> float:
     logging.info(f"Getting stock price for {symbol}")
-    stock = yf.Ticker(symbol)
-    price = stock.history(period="1d")['Close'].iloc[-1]
-    return price
-
-
-def send_logic_apps_email(email_url: str, to: str, content: str):
-    try:
-        logging.info(f"Sending email to {to}")
-        json_payload = {'to': to, 'content':  html.unescape(content)}
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(email_url, json=json_payload, headers=headers)
-        if response.status_code == 202:
-            print("Email sent to: " + json_payload['to'])
-    except Exception as e:
-        logging.error(f"Unable to send email due to {e}")
-
-
-class Country:
-    def __init__(self, data):
-        self.name = data[0]['name']
-        self.tld = data[0]['tld']
-        self.cca2 = data[0]['cca2']
-        self.ccn3 = data[0]['ccn3']
-        self.cca3 = data[0]['cca3']
-        self.cioc = data[0]['cioc']
-        self.independent = data[0]['independent']
-        self.status = data[0]['status']
-        self.unMember = data[0]['unMember']
-        self.currencies = data[0]['currencies']
-        self.idd = data[0]['idd']
-        self.capital = data[0]['capital']
-        self.altSpellings = data[0]['altSpellings']
-        self.region = data[0]['region']
-        self.subregion = data[0]['subregion']
-        self.languages = data[0]['languages']
-        self.translations = data[0]['translations']
-        self.latlng = data[0]['latlng']
-        self.landlocked = data[0]['landlocked']
-        self.borders = data[0]['borders']
-        self.area = data[0]['area']
-        self.demonyms = data[0]['demonyms']
-        self.flag = data[0]['flag']
-        self.maps = data[0]['maps']
-        self.population = data[0]['population']
-        self.gini = data[0]['gini']
-        self.fifa = data[0]['fifa']
-        self.car = data[0]['car']
-        self.timezones = data[0]['timezones']
-        self.continents = data[0]['continents']
-        self.flags = data[0]['flags']
-        self.coatOfArms = data[0]['coatOfArms']
-        self.startOfWeek = data[0]['startOfWeek']
-        self.capitalInfo = data[0]['capitalInfo']
-        self.postalCode = data[0]['postalCode']
-        self.latitude = data[0]['latitude']
-        self.longitude = data[0]['longitude']
-        self.areaKm2 = data[0]['areaKm2']
-        self.areaMi2 = data[0]['areaMi2']
-        self.areaInfo = data[0]['areaInfo']
-        self.populationInfo = data[0]['populationInfo']
-        self.elevation = data[0]['elevation']
-        self.elevationInfo = data[0]['elevationInfo']
-        self.demonym = data[0]['demonym']
-        self.demonymInfo = data[0]['demonymInfo']
-        self.currency = data[0]['currency']
-        # self.currencyInfo = data[0]['currencyInfo']
-        # self.currencyCode = data[0]['currencyCode']
-        # self.currencySubUnit = data[0]['currencySubUnit']
-        # self.currencyInfo = data[0]['currencyInfo']
-        # self.currencySubUnit = data[0]['currencySubUnit']
-        # self.currencySubUnitInfo = data[0]['currencySubUnitInfo']
-        # self.currencyFraction = data[0]['currencyFraction']
-        # self.currencyFractionInfo = data[0]['currencyFractionInfo']
-        # self.currencySymbol = data[0]['currencySymbol']
-        # self.currencySymbolInfo = data[0]['currencySymbolInfo']
-        # self.currencyDecimals = data[0]['currencyDecimals']
-        # self.currencyDecimalsInfo = data[0]['currencyDecimalsInfo']
-        # self.currencyThousandsSeparator = data[0]['currencyThousandsSeparator']
-        # self.currencyThousandsSeparatorInfo = data[0]['currencyThousandsSeparatorInfo']
-        # self.currencyPrefix = data[0]['currencyPrefix']
-        # self.currencyPrefixInfo = data[0]['currencyPrefixInfo']
-        # self.currencySuffix = data[0]['currencySuffix']
-        # self.currencySuffixInfo = data[0]['currencySuffixInfo']
-
-
-def get_country_data(country: str) -> str:
-    resp = requests.get(
-        f"https://restcountries.com/v3.1/name/{country}", headers={"Accept": "application/json"})
-    resp.raise_for_status()
-    country = Country(resp.json())
-    return f'Country: {country.name}\nCapital: {country.capital}\nPopulation: {country.population}\nArea: {country.area} km²\nRegion: {country.region}\nSubregion: {country.subregion}'
+    return quotes.get_quote(symbol)
+
+
+def get_stock_prices(symbols: list[str]) -> dict[str, float]:
+    # Resolve several symbols with one request, the prices are cached for get_stock_price
+    return quotes.get_quotes(symbols)
+
+
+def send_logic_apps_email(email_url: str, to: str, content: str) -> int | None:
+    # Queue the email, the outbox delivers it in the background
+    logging.info(f"Queueing email to {to}")
+    id = kvstore.enqueue_email(email_url, to, html.unescape(content))
+    if id is not None:
+        outbox.Instance().wake()
+    return id
+
+
+async def get_country_data(country: str) -> str:
+    config = settings.Instance()
+    index = countries.get_index(config.countries_snapshot)
+    if index is None:
+        # No snapshot and no seed, download it once for all the lookups
+        index = await countries.refresh(clients.Http(), config.countries_snapshot)
+    record = index.lookup(country)
+    if record is None:
+        raise LookupError(f"Country not found: {country}")
+    return record.describe()
+
+
+# Tool registry
+# Each tool declares its schema, its handler and how the handler runs:
+#   sync     - a quick function called on the event loop
+#   async    - a coroutine function awaited on the event loop
+#   blocking - a function that does I/O, run on the tool worker pool
+JSON_TYPES = {"string": (str,), "number": (int, float), "integer": (int,),
+              "boolean": (bool,), "array": (list,), "object": (dict,)}
+
+
+def compile_validator(name: str, parameters: dict):
+    # Precompute what each call needs to check
+    properties = parameters.get("properties", {})
+    required = tuple(parameters.get("required", []))
+    types = {property: JSON_TYPES[schema["type"]]
+             for (property, schema) in properties.items() if "type" in schema}
+
+    def validate(arguments) -> dict:
+        if not isinstance(arguments, dict):
+            raise ValueError(f"{name} expects an object of arguments")
+        missing = [property for property in required if property not in arguments]
+        if missing:
+            raise ValueError(
+                f"{name} is missing the argument(s): {', '.join(missing)}")
+        valid = {}
+        for (property, value) in arguments.items():
+            if property not in properties:
+                continue
+            if property in types and not isinstance(value, types[property]):
+                raise ValueError(
+                    f"{name} argument {property} must be of type {properties[property]['type']}")
+            valid[property] = value
+        return valid
+    return validate
+
+
+class Tool:
+    def __init__(self, name: str, description: str, parameters: dict, handler,
+                 kind: str = "blocking", context: tuple = (), timeout: float | None = None,
+                 prefetch=None):
+        if kind not in ("sync", "async", "blocking"):
+            raise ValueError(f"Unknown tool kind: {kind}")
+        self.name = name
+        self.kind = kind
+        self.handler = handler
+        # Values the handler needs from the caller, e.g. the email uri
+        self.context = context
+        # Overrides TOOL_TIMEOUT for this tool
+        self.timeout = timeout
+        # Optional function taking the arguments of several calls to resolve them in one request
+        self.prefetch = prefetch
+        self.schema = {"type": "function",
+                       "function": {"name": name, "description": description, "parameters": parameters}}
+        self.validate = compile_validator(name, parameters)
+
+
+registry: dict[str, Tool] = {}
+
+
+def register(tool: Tool):
+    registry[tool.name] = tool
+
+
+async def call(name: str, arguments: str, context: dict, executor) -> str:
+    """Validate the JSON arguments and run the tool, returning its output."""
+    tool = registry.get(name)
+    if tool is None:
+        raise LookupError(f"Unknown function: {name}")
+    kwargs = tool.validate(json.loads(arguments))
+    for key in tool.context:
+        kwargs[key] = context[key]
+    if tool.kind == "async":
+        return await tool.handler(**kwargs)
+    if tool.kind == "sync":
+        return tool.handler(**kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(tool.handler, **kwargs))
+
+
+register(Tool(
+    name="get_stock_price",
+    description="Retrieve the latest closing price of a stock using its ticker symbol.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "symbol": {
+                "type": "string",
+                "description": "The ticker symbol of the stock"
+            }
+        },
+        "required": ["symbol"]
+    },
+    handler=lambda symbol: str(get_stock_price(symbol)),
+    prefetch=lambda calls: get_stock_prices(
+        [arguments["symbol"] for arguments in calls])))
+
+
+def __send_email(to: str, content: str, email_uri: str) -> str:
+    if send_logic_apps_email(email_uri, to, content) is None:
+        return "Unable to send the email"
+    return "Email queued for delivery"
+
+
+register(Tool(
+    name="send_email",
+    description="Sends an email to a recipient(s).",
+    parameters={
+        "type": "object",
+        "properties": {
+            "to": {
+                "type": "string",
+                "description": "The email(s) the email should be sent to."
+            },
+            "content": {
+                "type": "string",
+                "description": "The content of the email."
+            }
+        },
+        "required": ["to", "content"]
+    },
+    handler=__send_email,
+    kind="sync",
+    context=("email_uri",)))
+
+
+register(Tool(
+    name="get_country_data",
+    description="Retrieve the capital, population, area and region of a country.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "country": {
+                "type": "string",
+                "description": "The name of the country"
+            }
+        },
+        "required": ["country"]
+    },
+    handler=get_country_data,
+    kind="async"))
+
+
+# The Assistant tools, serialized once
+tools_list = [{"type": "code_interpreter"}] + \
+    [tool.schema for tool in registry.values()]
+tools_json = json.dumps(tools_list)
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+
+import kvstore
+import settings
+
+# A reservation for a pooled thread that was not created within this long is dropped (seconds)
+RESERVATION_TTL = 120
+
+
+class WarmThreadPool:
+    """Keeps a number of empty threads ready so new users don't wait for one.
+
+    The pooled thread ids are kept in the kvstore, so they survive restarts
+    and are shared by the workers. A background task tops the pool up after
+    every claim and periodically recycles the threads older than ttl. The
+    threads to create are reserved in the kvstore first, so the workers
+    topping the pool up together stop at size.
+    """
+
+    def __init__(self, size: int, ttl: float, refill_interval: float):
+        self.size = size
+        self.ttl = ttl
+        self.refill_interval = refill_interval
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.recycled = 0
+        self._client = None
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self, client):
+        """Start refilling the pool with threads made by client."""
+        self._client = client
+        if self.size <= 0:
+            return
+        self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.__refill())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def claim(self, client) -> str:
+        """Return the id of an empty thread, from the pool when one is ready."""
+        thread_id = None
+        if self.size > 0:
+            thread_id = kvstore.claim_pooled_thread(time.time() - self.ttl)
+        # Top the pool up again
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if thread_id is not None:
+            self.hits += 1
+            return thread_id
+        self.misses += 1
+        thread = await client.beta.threads.create()
+        return thread.id
+
+    def stats(self) -> dict:
+        return {"size": kvstore.count_pooled_threads(), "target": self.size,
+                "hits": self.hits, "misses": self.misses,
+                "created": self.created, "recycled": self.recycled}
+
+    async def __refill(self):
+        while True:
+            # Claims made while refilling trigger another pass
+            self._wakeup.clear()
+            try:
+                await self.__recycle()
+                now = time.time()
+                reservations = kvstore.reserve_pooled_threads(
+                    self.size, now, now - RESERVATION_TTL)
+                if reservations:
+                    results = await asyncio.gather(*[self.__create(reservation) for reservation in reservations],
+                                                   return_exceptions=True)
+                    for result in results:
+                        if isinstance(result, Exception):
+                            logging.warning(
+                                f"Unable to create a pooled thread: {result}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Unable to refill the thread pool: {e}")
+
+            # Wait for a claim or the next refill period
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __create(self, reservation: int):
+        try:
+            thread = await self._client.beta.threads.create()
+        except BaseException:
+            kvstore.cancel_pooled_thread(reservation)
+            raise
+        kvstore.add_pooled_thread(thread.id, time.time(), reservation)
+        self.created += 1
+
+    async def __recycle(self):
+        expired = kvstore.expire_pooled_threads(time.time() - self.ttl)
+        for thread_id in expired:
+            try:
+                await self._client.beta.threads.delete(thread_id)
+            except:
+                logging.warning(f"Unable to delete thread: {thread_id}")
+        self.recycled += len(expired)
+
+
+pool = None
+
+
+def Instance() -> WarmThreadPool:
+    global pool
+    if pool is None:
+        config = settings.Instance()
+        pool = WarmThreadPool(config.thread_pool_size, config.thread_pool_ttl,
+                              config.thread_pool_refill_interval)
+    return pool